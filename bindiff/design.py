@@ -115,8 +115,12 @@ def inference(model, loader):
     dna_seq = str(batch.dna_sequence[0])
     cmask = batch.complex_mask
 
-    # run diffusion
-    results = model.diffusion.sample(model.transformer, crd, seq, msk, model.diffusion.timesteps)
+    # run diffusion, through traced graphs cached next to the outputs
+    # traces search neighbors densely inside the graph, so no neighbor lists are built
+    model.trace(cache_dir=os.path.join(OUTPUT_PATH, 'traces'))
+    results = model.diffusion.sample(model.denoise, crd, seq, msk, model.diffusion.timesteps,
+                                     num_steps=model.sample_steps, spacing=model.sample_spacing, eta=model.sample_eta,
+                                     offload='cpu')
     results = [x[0][cmask[0]].squeeze(0) for x in results]
 
     # save PDB files for diffusion steps
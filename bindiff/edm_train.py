@@ -65,7 +65,15 @@ def cli_main():
     # ------------
     # model
     # ------------
-    model = EGNNDenoiser(nodes_dist=nodes_dist)
+    model = EGNNDenoiser(
+        nodes_dist=nodes_dist,
+        graph=args.graph,
+        neighbors=args.neighbors,
+        graph_radius=args.graph_radius,
+        packed=args.packed,
+        sanity_checks=args.sanity_checks,
+        sanity_check_every=args.sanity_check_every
+    )
 
     # ------------
     # logging
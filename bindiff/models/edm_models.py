@@ -1,17 +1,34 @@
+from collections import OrderedDict
+
 import torch
 from torch import nn
 from models.egnn_new import EGNN, GNN
-from sampling.diffusion_utils import remove_mean, remove_mean_with_mask
+from models.neighbors import grid_knn
+from sampling.diffusion_utils import remove_mean, remove_mean_with_mask, remove_mean_packed
 import numpy as np
 
 
+# largest graph run on the dense backend when backend='auto'
+DENSE_MAX_NODES = 256
+
+# hidden sized edge activations alive at once in an egnn layer, for memory estimates
+EDGE_ACTIVATIONS = 6
+
+
 class EGNN_dynamics_QM9(nn.Module):
     def __init__(self, in_node_nf, context_node_nf,
                  n_dims, hidden_nf=64,
                  act_fn=torch.nn.SiLU(), n_layers=2, attention=False,
                  condition_time=True, tanh=False, mode='egnn_dynamics', norm_constant=0,
-                 inv_sublayers=2, sin_embedding=False, normalization_factor=100, aggregation_method='sum'):
+                 inv_sublayers=2, sin_embedding=False, normalization_factor=100, aggregation_method='sum',
+                 edge_cache_size=32, graph='full', graph_neighbors=16, graph_radius=float('inf'),
+                 backend='auto', dense_max_nodes=DENSE_MAX_NODES, packed=False):
         super().__init__()
+        assert graph in {'full', 'knn', 'radius'}, 'graph must be one of full, knn or radius'
+        assert backend in {'auto', 'sparse', 'dense'}, 'backend must be one of auto, sparse or dense'
+        assert backend != 'dense' or (graph == 'full' and mode == 'egnn_dynamics'), 'the dense backend needs a full graph egnn'
+        assert not (packed and backend == 'dense'), 'packed batches run on the sparse backend'
+        assert graph != 'radius' or graph_radius < float('inf'), 'radius graphs need a finite graph_radius'
         self.mode = mode
         if mode == 'egnn_dynamics':
             self.egnn = EGNN(
@@ -31,9 +48,27 @@ class EGNN_dynamics_QM9(nn.Module):
 
         self.context_node_nf = context_node_nf
         self.n_dims = n_dims
-        self._edges_dict = {}
+        self.hidden_nf = hidden_nf
+        # fully connected edges per (n_nodes, batch_size, device), least recently used evicted first
+        self._edges_dict = OrderedDict()
+        self.edge_cache_size = edge_cache_size
+
+        # sparse graphs connect every node to at most graph_neighbors nearest nodes, within graph_radius
+        self.graph = graph
+        self.graph_neighbors = graph_neighbors
+        self.graph_radius = graph_radius
+
+        # fully connected egnn graphs run on dense pair tensors, by default only up to dense_max_nodes nodes
+        self.backend = backend
+        self.dense_max_nodes = dense_max_nodes
+
+        # packed batches only run the real nodes of every graph through the network, no edge mask is needed
+        self.packed = packed
         self.condition_time = condition_time
 
+        # number of outputs reset to zero for nans, kept on device until read by the sampler
+        self.nan_resets = None
+
     def forward(self, t, xh, node_mask, edge_mask, context=None):
         raise NotImplementedError
 
@@ -45,16 +80,40 @@ class EGNN_dynamics_QM9(nn.Module):
     def unwrap_forward(self):
         return self._forward
 
-    def _forward(self, t, xh, node_mask, edge_mask, context):
-        bs, n_nodes, dims = xh.shape
-        h_dims = dims - self.n_dims
-        edges = self.get_adj_matrix(n_nodes, bs)
-        node_mask = node_mask.view(bs*n_nodes, 1)
-        edge_mask = edge_mask.view(bs*n_nodes*n_nodes, 1)
-        xh = xh.view(bs*n_nodes, -1).clone() * node_mask
+    def reset_nan(self, vel):
+        # resets the whole output to zero when it has a nan, without syncing with the host
+        nan = torch.isnan(vel).any()
+        self.nan_resets = nan.long() if self.nan_resets is None else self.nan_resets + nan
+        return torch.where(nan, torch.zeros_like(vel), vel)
+
+    def pop_nan_resets(self):
+        nan_resets, self.nan_resets = self.nan_resets, None
+        return nan_resets
+
+    def sample_memory(self, n_nodes, dtype=torch.float32):
+        """Rough peak activation memory in bytes of a forward pass over one graph without gradients."""
+        if self.graph == 'full':
+            n_edges = n_nodes * n_nodes
+        else:
+            n_edges = n_nodes * min(self.graph_neighbors + 1, n_nodes)
+
+        element_size = torch.finfo(dtype).bits // 8
+        return n_edges * self.hidden_nf * EDGE_ACTIVATIONS * element_size
+
+    def use_dense(self, n_nodes):
+        if self.packed:
+            return False
+        if self.backend == 'auto':
+            return self.graph == 'full' and self.mode == 'egnn_dynamics' and n_nodes <= self.dense_max_nodes
+        return self.backend == 'dense'
+
+    def node_inputs(self, t, xh, context, graph_index):
+        """Splits the flat node states xh into coordinates and features, then appends the time and context
+            inputs to the features. graph_index is the graph of every node, context is already laid out per node.
+        """
         x = xh[:, 0:self.n_dims].clone()
-        if h_dims == 0:
-            h = torch.ones(bs*n_nodes, 1)
+        if xh.size(1) == self.n_dims:
+            h = torch.ones(xh.size(0), 1, device=xh.device)
         else:
             h = xh[:, self.n_dims:].clone()
 
@@ -64,28 +123,27 @@ class EGNN_dynamics_QM9(nn.Module):
                 h_time = torch.empty_like(h[:, 0:1]).fill_(t.item())
             else:
                 # t is different over the batch dimension.
-                h_time = t.view(bs, 1).repeat(1, n_nodes)
-                h_time = h_time.view(bs * n_nodes, 1)
-            h_time = h_time.to(h.device)
+                h_time = t.view(-1, 1).to(h)[graph_index]
             h = torch.cat([h, h_time], dim=1)
 
         if context is not None:
             # We're conditioning, awesome!
-            context = context.view(bs*n_nodes, self.context_node_nf)
             h = torch.cat([h, context], dim=1)
+        return x, h
 
+    def run_sparse(self, x, h, edges, node_mask=None, edge_mask=None):
+        # the network over an edge list, returns the output features and the unmasked velocity
         if self.mode == 'egnn_dynamics':
-            h_final, x_final = self.egnn(h, x, edges, node_mask=node_mask, edge_mask=edge_mask)
-            vel = (x_final - x) * node_mask  # This masking operation is redundant but just in case
+            h_final, x_final = self.egnn(h, x, edges, node_mask=node_mask, edge_mask=edge_mask, sorted_edges=True)
+            return h_final, x_final - x
         elif self.mode == 'gnn_dynamics':
-            xh = torch.cat([x, h], dim=1)
-            output = self.gnn(xh, edges, node_mask=node_mask)
-            vel = output[:, 0:3] * node_mask
-            h_final = output[:, 3:]
-
+            output = self.gnn(torch.cat([x, h], dim=1), edges, node_mask=node_mask, sorted_edges=True)
+            return output[:, 3:], output[:, 0:3]
         else:
             raise Exception("Wrong mode %s" % self.mode)
 
+    def node_outputs(self, h_final, vel, context):
+        # slices the context and time inputs off the features, resets the velocity when it has nans
         if context is not None:
             # Slice off context size:
             h_final = h_final[:, :-self.context_node_nf]
@@ -94,16 +152,47 @@ class EGNN_dynamics_QM9(nn.Module):
             # Slice off last dimension which represented time.
             h_final = h_final[:, :-1]
 
-        vel = vel.view(bs, n_nodes, -1)
+        return h_final, self.reset_nan(vel)
+
+    def _forward(self, t, xh, node_mask, edge_mask, context):
+        if self.packed:
+            return self._forward_packed(t, xh, node_mask, context)
+
+        bs, n_nodes, dims = xh.shape
+        h_dims = dims - self.n_dims
+        dense = self.use_dense(n_nodes)
+        if dense:
+            edges = None
+            edge_mask = edge_mask.view(bs, n_nodes, n_nodes, 1)
+        elif self.graph == 'full':
+            edges = self.get_adj_matrix(n_nodes, bs, xh.device)
+            edge_mask = edge_mask.view(bs*n_nodes*n_nodes, 1)
+        else:
+            # edges only exist between real nodes, so no edge mask is needed
+            edges = self.get_graph_edges(xh[:, :, 0:self.n_dims], node_mask)
+            edge_mask = None
+        node_mask = node_mask.view(bs*n_nodes, 1)
+        xh = xh.view(bs*n_nodes, -1).clone() * node_mask
+        graph_index = torch.arange(bs, device=xh.device).repeat_interleave(n_nodes)
+        if context is not None:
+            context = context.view(bs*n_nodes, self.context_node_nf)
+        x, h = self.node_inputs(t, xh, context, graph_index)
+
+        if self.mode == 'egnn_dynamics' and dense:
+            h_final, x_final = self.egnn.forward_dense(h.view(bs, n_nodes, -1), x.view(bs, n_nodes, -1),
+                                                       node_mask=node_mask.view(bs, n_nodes, 1), edge_mask=edge_mask)
+            h_final, vel = h_final.view(bs*n_nodes, -1), x_final.view(bs*n_nodes, -1) - x
+        else:
+            h_final, vel = self.run_sparse(x, h, edges, node_mask=node_mask, edge_mask=edge_mask)
+        vel = vel * node_mask  # This masking operation is redundant but just in case
 
-        if torch.any(torch.isnan(vel)):
-            print('Warning: detected nan, resetting EGNN output to zero.')
-            vel = torch.zeros_like(vel)
+        h_final, vel = self.node_outputs(h_final, vel.view(bs, n_nodes, -1), context)
 
         if node_mask is None:
             vel = remove_mean(vel)
         else:
-            vel = remove_mean_with_mask(vel, node_mask.view(bs, n_nodes, 1))
+            # vel was masked above
+            vel = remove_mean_with_mask(vel, node_mask.view(bs, n_nodes, 1), check=False)
 
         if h_dims == 0:
             return vel
@@ -111,23 +200,78 @@ class EGNN_dynamics_QM9(nn.Module):
             h_final = h_final.view(bs, n_nodes, -1)
             return torch.cat([vel, h_final], dim=2)
 
-    def get_adj_matrix(self, n_nodes, batch_size):
-        if n_nodes in self._edges_dict:
-            edges_dic_b = self._edges_dict[n_nodes]
-            if batch_size in edges_dic_b:
-                return edges_dic_b[batch_size]
-            else:
-                # get edges for a single sample
-                rows, cols = [], []
-                for batch_idx in range(batch_size):
-                    for i in range(n_nodes):
-                        for j in range(n_nodes):
-                            rows.append(i + batch_idx * n_nodes)
-                            cols.append(j + batch_idx * n_nodes)
-                edges = [torch.LongTensor(rows),
-                         torch.LongTensor(cols)]
-                edges_dic_b[batch_size] = edges
-                return edges
-        else:
-            self._edges_dict[n_nodes] = {}
-            return self.get_adj_matrix(n_nodes, batch_size)
+    # every edge builder below returns rows in ascending order, which the aggregation relies on
+    def get_adj_matrix(self, n_nodes, batch_size, device='cpu'):
+        key = (n_nodes, batch_size, torch.device(device))
+        if key in self._edges_dict:
+            self._edges_dict.move_to_end(key)
+            return self._edges_dict[key]
+
+        # all (i, j) pairs within each sample, rows ordered by batch then i then j
+        idx = torch.arange(n_nodes, device=device)
+        offsets = torch.arange(batch_size, device=device).view(batch_size, 1, 1) * n_nodes
+        rows = (idx.view(1, n_nodes, 1) + offsets).expand(-1, -1, n_nodes).reshape(-1)
+        cols = (idx.view(1, 1, n_nodes) + offsets).expand(-1, n_nodes, -1).reshape(-1)
+        edges = [rows, cols]
+
+        self._edges_dict[key] = edges
+        if len(self._edges_dict) > self.edge_cache_size:
+            self._edges_dict.popitem(last=False)
+        return edges
+
+    def get_graph_edges(self, x, node_mask):
+        bs, n_nodes, _ = x.shape
+        mask = node_mask.view(bs, n_nodes).bool()
+
+        # every node is its own nearest neighbor, as in the fully connected graph
+        k = min(self.graph_neighbors + 1, n_nodes)
+        dist, nbhd = grid_knn(x, k, mask=mask, radius=self.graph_radius)
+        valid = torch.isfinite(dist) & (dist <= self.graph_radius) & mask.unsqueeze(-1)
+
+        # flattened over the batch, rows stay sorted
+        offsets = torch.arange(bs, device=x.device).view(bs, 1, 1) * n_nodes
+        rows = torch.arange(n_nodes, device=x.device).view(1, n_nodes, 1) + offsets
+        rows = rows.expand(-1, -1, k)[valid]
+        cols = (nbhd + offsets)[valid]
+        return [rows, cols]
+
+    def get_packed_edges(self, x, node_mask):
+        bs, n_nodes, _ = x.shape
+        mask = node_mask.view(bs, n_nodes).bool()
+
+        if self.graph == 'full':
+            # block diagonal fully connected graph over the real nodes of every graph
+            counts = mask.sum(1)
+            graph = torch.repeat_interleave(torch.arange(bs, device=x.device), counts * counts)
+            pair_starts = (counts * counts).cumsum(0) - counts * counts
+            local = torch.arange(graph.size(0), device=x.device) - pair_starts[graph]
+            starts = counts.cumsum(0) - counts
+            rows = starts[graph] + torch.div(local, counts[graph], rounding_mode='floor')
+            cols = starts[graph] + local % counts[graph]
+            return [rows, cols]
+
+        # sparse graphs are built on the padded layout and moved to packed node positions
+        packed_index = mask.flatten().long().cumsum(0) - 1
+        rows, cols = self.get_graph_edges(x, node_mask)
+        return [packed_index[rows], packed_index[cols]]
+
+    def _forward_packed(self, t, xh, node_mask, context):
+        bs, n_nodes, dims = xh.shape
+        h_dims = dims - self.n_dims
+        batch, index = node_mask.view(bs, n_nodes).bool().nonzero(as_tuple=True)
+        edges = self.get_packed_edges(xh[:, :, 0:self.n_dims], node_mask)
+
+        if context is not None:
+            context = context.view(bs, n_nodes, self.context_node_nf)[batch, index]
+        x, h = self.node_inputs(t, xh[batch, index], context, batch)
+
+        h_final, vel = self.run_sparse(x, h, edges)
+        h_final, vel = self.node_outputs(h_final, vel, context)
+
+        vel = remove_mean_packed(vel, batch, bs)
+
+        # back to the padded layout, padding stays zero
+        out = vel if h_dims == 0 else torch.cat([vel, h_final], dim=1)
+        result = xh.new_zeros((bs, n_nodes, out.size(1)))
+        result[batch, index] = out
+        return result
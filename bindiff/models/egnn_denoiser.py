@@ -1,6 +1,7 @@
 import torch
 from torch import optim
 import torch.nn.functional as F
+import argparse
 from argparse import ArgumentParser
 import pytorch_lightning as pl
 from einops import rearrange, repeat
@@ -20,6 +21,11 @@ class EGNNDenoiser(pl.LightningModule):
                  depth=4,
                  rel_pos_emb=True,
                  neighbors=16,
+                 graph='full',
+                 graph_radius=float('inf'),
+                 packed=False,
+                 sanity_checks='always',
+                 sanity_check_every=10,
                  beta_small=2e-4,
                  beta_large=0.02,
                  timesteps=100,
@@ -37,15 +43,22 @@ class EGNNDenoiser(pl.LightningModule):
         net_dynamics = EGNN_dynamics_QM9(
             in_node_nf=dynamincs_in_node_nf,
             context_node_nf=0,
-            n_dims=3
+            n_dims=3,
+            graph=graph,
+            graph_neighbors=neighbors,
+            graph_radius=graph_radius,
+            packed=packed
         )
 
         self.model = EnVariationalDiffusion(
             dynamics=net_dynamics,
             in_node_nf=in_node_nf,
-            n_dims=3
+            n_dims=3,
+            sanity_checks=sanity_checks,
+            sanity_check_every=sanity_check_every
         )
 
+        self.packed = packed
         self.lr = lr
 
     def prepare_inputs(self, x):
@@ -62,8 +75,10 @@ class EGNNDenoiser(pl.LightningModule):
         node_mask = rearrange(node_mask, 'b l s -> b (l s)')
         node_mask = node_mask.unsqueeze(-1).int()
 
-        # compute edge mask
-        edge_mask = node_mask.unsqueeze(1) * node_mask.unsqueeze(2)
+        # compute edge mask, packed batches only connect real nodes and need none
+        edge_mask = None
+        if not self.packed:
+            edge_mask = node_mask.unsqueeze(1) * node_mask.unsqueeze(2)
 
         # assign sequence token to each of the backbone atoms
         seq = repeat(seq, 'b n -> b (n c)', c=4)
@@ -90,22 +105,31 @@ class EGNNDenoiser(pl.LightningModule):
         loss = nll + ode_regularization * reg_term
         return loss
 
+    def log_nan_resets(self, stage, batch_size):
+        # outputs reset for nans are counted on device, logged alongside the loss
+        nan_resets = self.model.dynamics.pop_nan_resets()
+        if nan_resets is not None:
+            self.log(f"{stage}_nan_resets", nan_resets.float(), batch_size=batch_size)
+
     def training_step(self, batch, batch_idx):
         batch_size = batch.atom_coord.shape[0]
         loss = self.step(batch)
         self.log("train_loss", loss, batch_size=batch_size)
+        self.log_nan_resets("train", batch_size)
         return loss
 
     def validation_step(self, batch, batch_idx):
         batch_size = batch.atom_coord.shape[0]
         loss = self.step(batch)
         self.log("val_loss", loss, batch_size=batch_size)
+        self.log_nan_resets("val", batch_size)
         return loss
 
     def test_step(self, batch, batch_idx):
         batch_size = batch.atom_coord.shape[0]
         loss = self.step(batch)
         self.log("test_loss", loss, batch_size=batch_size)
+        self.log_nan_resets("test", batch_size)
         return loss
 
     def configure_optimizers(self):
@@ -122,4 +146,10 @@ class EGNNDenoiser(pl.LightningModule):
         parser.add_argument('--depth', type=int, default=8)
         parser.add_argument('--timesteps', type=int, default=100)
         parser.add_argument('--schedule', type=str, default='linear')
+        parser.add_argument('--graph', type=str, default='full')
+        parser.add_argument('--neighbors', type=int, default=16)
+        parser.add_argument('--graph_radius', type=float, default=float('inf'))
+        parser.add_argument('--packed', action=argparse.BooleanOptionalAction)
+        parser.add_argument('--sanity_checks', type=str, default='always')
+        parser.add_argument('--sanity_check_every', type=int, default=10)
         return parser
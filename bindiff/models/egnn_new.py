@@ -45,11 +45,12 @@ class GCL(nn.Module):
             out = out * edge_mask
         return out, mij
 
-    def node_model(self, x, edge_index, edge_attr, node_attr):
+    def node_model(self, x, edge_index, edge_attr, node_attr, segments=None):
         row, col = edge_index
-        agg = unsorted_segment_sum(edge_attr, row, num_segments=x.size(0),
-                                   normalization_factor=self.normalization_factor,
-                                   aggregation_method=self.aggregation_method)
+        if segments is None:
+            segments = SegmentIndex(row, x.size(0))
+        agg = segments.aggregate(edge_attr, normalization_factor=self.normalization_factor,
+                                 aggregation_method=self.aggregation_method)
         if node_attr is not None:
             agg = torch.cat([x, agg, node_attr], dim=1)
         else:
@@ -57,10 +58,35 @@ class GCL(nn.Module):
         out = x + self.node_mlp(agg)
         return out, agg
 
-    def forward(self, h, edge_index, edge_attr=None, node_attr=None, node_mask=None, edge_mask=None):
+    def forward(self, h, edge_index, edge_attr=None, node_attr=None, node_mask=None, edge_mask=None, segments=None):
         row, col = edge_index
         edge_feat, mij = self.edge_model(h[row], h[col], edge_attr, edge_mask)
-        h, agg = self.node_model(h, edge_index, edge_feat, node_attr)
+        h, agg = self.node_model(h, edge_index, edge_feat, node_attr, segments)
+        if node_mask is not None:
+            h = h * node_mask
+        return h, mij
+
+    def forward_dense(self, h, edge_attr, node_mask=None, edge_mask=None):
+        """Fully connected graph on dense pair tensors, h is (b, n, d) and edge_attr (b, n, n, e)."""
+        n_nodes = h.size(1)
+        mij = self.edge_mlp[1:](pair_linear(self.edge_mlp[0], h, edge_attr))
+
+        if self.attention:
+            out = mij * self.att_mlp(mij)
+        else:
+            out = mij
+
+        if edge_mask is not None:
+            out = out * edge_mask
+
+        # every node has n edges in the fully connected graph
+        agg = out.sum(dim=2)
+        if self.aggregation_method == 'sum':
+            agg = agg / self.normalization_factor
+        if self.aggregation_method == 'mean':
+            agg = agg / n_nodes
+
+        h = h + self.node_mlp(torch.cat([h, agg], dim=-1))
         if node_mask is not None:
             h = h * node_mask
         return h, mij
@@ -84,7 +110,7 @@ class EquivariantUpdate(nn.Module):
         self.normalization_factor = normalization_factor
         self.aggregation_method = aggregation_method
 
-    def coord_model(self, h, coord, edge_index, coord_diff, edge_attr, edge_mask):
+    def coord_model(self, h, coord, edge_index, coord_diff, edge_attr, edge_mask, segments=None):
         row, col = edge_index
         input_tensor = torch.cat([h[row], h[col], edge_attr], dim=1)
         if self.tanh:
@@ -93,14 +119,36 @@ class EquivariantUpdate(nn.Module):
             trans = coord_diff * self.coord_mlp(input_tensor)
         if edge_mask is not None:
             trans = trans * edge_mask
-        agg = unsorted_segment_sum(trans, row, num_segments=coord.size(0),
-                                   normalization_factor=self.normalization_factor,
-                                   aggregation_method=self.aggregation_method)
+        if segments is None:
+            segments = SegmentIndex(row, coord.size(0))
+        agg = segments.aggregate(trans, normalization_factor=self.normalization_factor,
+                                 aggregation_method=self.aggregation_method)
         coord = coord + agg
         return coord
 
-    def forward(self, h, coord, edge_index, coord_diff, edge_attr=None, node_mask=None, edge_mask=None):
-        coord = self.coord_model(h, coord, edge_index, coord_diff, edge_attr, edge_mask)
+    def forward(self, h, coord, edge_index, coord_diff, edge_attr=None, node_mask=None, edge_mask=None, segments=None):
+        coord = self.coord_model(h, coord, edge_index, coord_diff, edge_attr, edge_mask, segments)
+        if node_mask is not None:
+            coord = coord * node_mask
+        return coord
+
+    def forward_dense(self, h, coord, coord_diff, edge_attr, node_mask=None, edge_mask=None):
+        n_nodes = h.size(1)
+        weight = self.coord_mlp[1:](pair_linear(self.coord_mlp[0], h, edge_attr))
+        if self.tanh:
+            trans = coord_diff * torch.tanh(weight) * self.coords_range
+        else:
+            trans = coord_diff * weight
+        if edge_mask is not None:
+            trans = trans * edge_mask
+
+        agg = trans.sum(dim=2)
+        if self.aggregation_method == 'sum':
+            agg = agg / self.normalization_factor
+        if self.aggregation_method == 'mean':
+            agg = agg / n_nodes
+
+        coord = coord + agg
         if node_mask is not None:
             coord = coord * node_mask
         return coord
@@ -130,21 +178,37 @@ class EquivariantBlock(nn.Module):
                                                        normalization_factor=self.normalization_factor,
                                                        aggregation_method=self.aggregation_method))
 
-    def forward(self, h, x, edge_index, node_mask=None, edge_mask=None, edge_attr=None):
+    def forward(self, h, x, edge_index, node_mask=None, edge_mask=None, edge_attr=None, segments=None):
         # Edit Emiel: Remove velocity as input
         distances, coord_diff = coord2diff(x, edge_index, self.norm_constant)
         if self.sin_embedding is not None:
             distances = self.sin_embedding(distances)
         edge_attr = torch.cat([distances, edge_attr], dim=1)
+        if segments is None:
+            segments = SegmentIndex(edge_index[0], h.size(0))
         for i in range(0, self.n_layers):
-            h, _ = self._modules["gcl_%d" % i](h, edge_index, edge_attr=edge_attr, node_mask=node_mask, edge_mask=edge_mask)
-        x = self._modules["gcl_equiv"](h, x, edge_index, coord_diff, edge_attr, node_mask, edge_mask)
+            h, _ = self._modules["gcl_%d" % i](h, edge_index, edge_attr=edge_attr, node_mask=node_mask, edge_mask=edge_mask,
+                                               segments=segments)
+        x = self._modules["gcl_equiv"](h, x, edge_index, coord_diff, edge_attr, node_mask, edge_mask, segments)
 
         # Important, the bias of the last linear might be non-zero
         if node_mask is not None:
             h = h * node_mask
         return h, x
 
+    def forward_dense(self, h, x, node_mask=None, edge_mask=None, edge_attr=None):
+        distances, coord_diff = coord2diff_dense(x, self.norm_constant)
+        if self.sin_embedding is not None:
+            distances = self.sin_embedding(distances)
+        edge_attr = torch.cat([distances, edge_attr], dim=-1)
+        for i in range(0, self.n_layers):
+            h, _ = self._modules["gcl_%d" % i].forward_dense(h, edge_attr, node_mask=node_mask, edge_mask=edge_mask)
+        x = self._modules["gcl_equiv"].forward_dense(h, x, coord_diff, edge_attr, node_mask, edge_mask)
+
+        if node_mask is not None:
+            h = h * node_mask
+        return h, x
+
 
 class EGNN(nn.Module):
     def __init__(self, in_node_nf, in_edge_nf, hidden_nf, act_fn=nn.SiLU(), n_layers=3, attention=False,
@@ -178,14 +242,17 @@ class EGNN(nn.Module):
                                                                normalization_factor=self.normalization_factor,
                                                                aggregation_method=self.aggregation_method))
 
-    def forward(self, h, x, edge_index, node_mask=None, edge_mask=None):
+    def forward(self, h, x, edge_index, node_mask=None, edge_mask=None, sorted_edges=False):
         # Edit Emiel: Remove velocity as input
         distances, _ = coord2diff(x, edge_index)
         if self.sin_embedding is not None:
             distances = self.sin_embedding(distances)
         h = self.embedding(h)
+        # the aggregation index is shared by every layer of every block
+        segments = SegmentIndex(edge_index[0], h.size(0), is_sorted=sorted_edges)
         for i in range(0, self.n_layers):
-            h, x = self._modules["e_block_%d" % i](h, x, edge_index, node_mask=node_mask, edge_mask=edge_mask, edge_attr=distances)
+            h, x = self._modules["e_block_%d" % i](h, x, edge_index, node_mask=node_mask, edge_mask=edge_mask, edge_attr=distances,
+                                                   segments=segments)
 
         # Important, the bias of the last linear might be non-zero
         h = self.embedding_out(h)
@@ -193,6 +260,23 @@ class EGNN(nn.Module):
             h = h * node_mask
         return h, x
 
+    def forward_dense(self, h, x, node_mask=None, edge_mask=None):
+        """Same as forward on the fully connected graph, with batched (b, n, ...) nodes and (b, n, n, ...) pairs
+            instead of an edge list. Loads the same weights.
+        """
+        distances, _ = coord2diff_dense(x)
+        if self.sin_embedding is not None:
+            distances = self.sin_embedding(distances)
+        h = self.embedding(h)
+        for i in range(0, self.n_layers):
+            h, x = self._modules["e_block_%d" % i].forward_dense(h, x, node_mask=node_mask, edge_mask=edge_mask,
+                                                                 edge_attr=distances)
+
+        h = self.embedding_out(h)
+        if node_mask is not None:
+            h = h * node_mask
+        return h, x
+
 
 class GNN(nn.Module):
     def __init__(self, in_node_nf, in_edge_nf, hidden_nf, aggregation_method='sum',
@@ -214,11 +298,13 @@ class GNN(nn.Module):
                 edges_in_d=in_edge_nf, act_fn=act_fn,
                 attention=attention))
 
-    def forward(self, h, edges, edge_attr=None, node_mask=None, edge_mask=None):
+    def forward(self, h, edges, edge_attr=None, node_mask=None, edge_mask=None, sorted_edges=False):
         # Edit Emiel: Remove velocity as input
         h = self.embedding(h)
+        segments = SegmentIndex(edges[0], h.size(0), is_sorted=sorted_edges)
         for i in range(0, self.n_layers):
-            h, _ = self._modules["gcl_%d" % i](h, edges, edge_attr=edge_attr, node_mask=node_mask, edge_mask=edge_mask)
+            h, _ = self._modules["gcl_%d" % i](h, edges, edge_attr=edge_attr, node_mask=node_mask, edge_mask=edge_mask,
+                                               segments=segments)
         h = self.embedding_out(h)
 
         # Important, the bias of the last linear might be non-zero
@@ -250,20 +336,63 @@ def coord2diff(x, edge_index, norm_constant=1):
     return radial, coord_diff
 
 
+def coord2diff_dense(x, norm_constant=1):
+    coord_diff = x.unsqueeze(2) - x.unsqueeze(1)
+    radial = torch.sum((coord_diff) ** 2, -1).unsqueeze(-1)
+    norm = torch.sqrt(radial + 1e-8)
+    coord_diff = coord_diff/(norm + norm_constant)
+    return radial, coord_diff
+
+
+def pair_linear(linear, h, edge_attr):
+    """First linear layer of an edge mlp on cat([h_i, h_j, edge_attr_ij]) without building the concatenation,
+        node terms are projected once per node and broadcast over the pairs.
+    """
+    d = h.size(-1)
+    w_source, w_target, w_edge = linear.weight.split([d, d, linear.in_features - 2 * d], dim=1)
+    out = (h @ w_source.t()).unsqueeze(2) + (h @ w_target.t()).unsqueeze(1) + linear.bias
+    if edge_attr is not None:
+        out = out + edge_attr @ w_edge.t()
+    return out
+
+
+class SegmentIndex:
+    """Aggregation index of a graph, computed once per graph and shared by every layer.
+        Keeps per node edge counts and, for edges ordered by row (is_sorted, given by the caller), CSR offsets.
+        Offsets of sorted edges are found by binary search, which unlike bincount needs no host sync.
+    """
+    def __init__(self, segment_ids, num_segments, is_sorted=False):
+        self.segment_ids = segment_ids.long()
+        self.num_segments = num_segments
+        self.is_sorted = is_sorted
+        if is_sorted:
+            bounds = torch.arange(num_segments + 1, device=self.segment_ids.device)
+            self.offsets = torch.searchsorted(self.segment_ids, bounds)
+            self.counts = self.offsets.diff()
+        else:
+            self.offsets = None
+            self.counts = torch.bincount(self.segment_ids, minlength=num_segments)
+
+    def sum(self, data):
+        # sorted segments are reduced in place on gpu, the offsets are exact so validation is skipped.
+        # scatter_add is faster on cpu
+        if self.is_sorted and data.is_cuda:
+            return torch.segment_reduce(data, 'sum', offsets=self.offsets, axis=0, unsafe=True)
+        index = self.segment_ids.unsqueeze(-1).expand(-1, data.size(1))
+        return data.new_zeros((self.num_segments, data.size(1))).scatter_add_(0, index, data)
+
+    def aggregate(self, data, normalization_factor, aggregation_method: str):
+        result = self.sum(data)
+        if aggregation_method == 'sum':
+            result = result / normalization_factor
+
+        if aggregation_method == 'mean':
+            result = result / self.counts.clamp(min=1).unsqueeze(-1).to(data)
+        return result
+
+
 def unsorted_segment_sum(data, segment_ids, num_segments, normalization_factor, aggregation_method: str):
     """Custom PyTorch op to replicate TensorFlow's `unsorted_segment_sum`.
         Normalization: 'sum' or 'mean'.
     """
-    result_shape = (num_segments, data.size(1))
-    result = data.new_full(result_shape, 0).to(data)  # Init empty result tensor.
-    segment_ids = segment_ids.unsqueeze(-1).expand(-1, data.size(1)).to(data).type(torch.int64)
-    result.scatter_add_(0, segment_ids, data)
-    if aggregation_method == 'sum':
-        result = result / normalization_factor
-
-    if aggregation_method == 'mean':
-        norm = data.new_zeros(result.shape)
-        norm.scatter_add_(0, segment_ids, data.new_ones(data.shape))
-        norm[norm == 0] = 1
-        result = result / norm
-    return result
+    return SegmentIndex(segment_ids, num_segments).aggregate(data, normalization_factor, aggregation_method)
@@ -9,10 +9,19 @@ import torch.nn.functional as F
 import pytorch_lightning as pl
 from einops import rearrange, repeat
 from models.equitransformer import EnTransformer
+from models.traced import TracedTransformer
+from models.helpers import exists
 from sampling.diffusion import Diffusion
 from visualize import pred_to_pdb
 from utils import calc_tm_score, calc_distmap_loss
 
+# parameter dtype of the network per precision policy, bf16 keeps float32 weights and autocasts
+PRECISION_POLICIES = {
+    'fp64': torch.float64,
+    'fp32': torch.float32,
+    'bf16': torch.float32
+}
+
 
 class EnDenoiser(pl.LightningModule):
 
@@ -23,9 +32,19 @@ class EnDenoiser(pl.LightningModule):
                  depth=4,
                  rel_pos_emb=True,
                  neighbors=0,
+                 neighbor_search='dense',
+                 neighbor_skin=None,
+                 attn_chunk_size=None,
+                 value_pos_rank=None,
+                 share_pos_bias=False,
+                 activation_checkpoint=False,
+                 checkpoint_memory_mb=None,
                  beta_small=2e-4,
                  beta_large=0.02,
                  timesteps=100,
+                 sample_steps=None,
+                 sample_spacing='uniform',
+                 sample_eta=1.,
                  bb_start=1,
                  bb_end=2,
                  trim=128,
@@ -33,10 +52,11 @@ class EnDenoiser(pl.LightningModule):
                  schedule='linear',
                  verbose=False,
                  context=False,
+                 precision_policy='fp32',
                  lr=1e-4):
         super().__init__()
 
-        torch.set_default_dtype(torch.float64)
+        assert precision_policy in PRECISION_POLICIES, f'precision_policy must be one of {list(PRECISION_POLICIES)}'
         self.save_hyperparameters()
 
         if trim:
@@ -50,9 +70,24 @@ class EnDenoiser(pl.LightningModule):
             heads=heads,
             depth=depth,
             rel_pos_emb=rel_pos_emb,
-            neighbors=neighbors
+            neighbors=neighbors,
+            neighbor_search=neighbor_search,
+            neighbor_skin=neighbor_skin,
+            attn_chunk_size=attn_chunk_size,
+            value_pos_rank=value_pos_rank,
+            share_pos_bias=share_pos_bias,
+            checkpoint=activation_checkpoint,
+            checkpoint_memory_mb=checkpoint_memory_mb
         )
 
+        # the network runs in the policy dtype, coordinates and schedules stay in float64
+        self.precision_policy = precision_policy
+        self.network_dtype = PRECISION_POLICIES[precision_policy]
+        self.transformer.to(self.network_dtype)
+
+        # traced inference graphs, see trace()
+        self.traced = None
+
         self.diffusion = Diffusion(
             beta_small=beta_small,
             beta_large=beta_large,
@@ -60,6 +95,12 @@ class EnDenoiser(pl.LightningModule):
             schedule=schedule
         )
 
+        # sampling runs sample_steps of the trained schedule, all of them by default
+        assert 0. <= sample_eta <= 1., 'sample_eta must lie in [0, 1]'
+        self.sample_steps = sample_steps
+        self.sample_spacing = sample_spacing
+        self.sample_eta = sample_eta
+
         self.bb_start = bb_start
         self.bb_end = bb_end
         self.trim = trim
@@ -91,6 +132,21 @@ class EnDenoiser(pl.LightningModule):
 
         return coords, seqs, masks
 
+    def trace(self, cache_dir=None, bucket_size=64):
+        # run inference through TorchScript traces bucketed by length, cached on disk in cache_dir
+        self.traced = TracedTransformer(self.transformer, cache_dir=cache_dir, bucket_size=bucket_size)
+        return self.traced
+
+    def denoise(self, coords, ts, **kwargs):
+        # inference from the transformer under the precision policy, outputs are cast back to the coordinate dtype
+        autocast = torch.autocast(coords.device.type, dtype=torch.bfloat16, enabled=self.precision_policy == 'bf16')
+        transformer = self.traced if exists(self.traced) and not self.training else self.transformer
+
+        with autocast:
+            feats, prediction = transformer(coords.type(self.network_dtype), ts.type(self.network_dtype), **kwargs)
+
+        return feats.type(coords.dtype), prediction.type(coords.dtype)
+
     def step(self, x):
         coords, seq, mask = self.prepare_inputs(x)
         cmask = x.complex_mask
@@ -103,14 +159,13 @@ class EnDenoiser(pl.LightningModule):
         # forward diffusion
         noised_coords, noise = self.diffusion.q_sample(coords, mask, ts)
         if not self.context:
-            noised_coords = noised_coords * mask.type(torch.float64)[..., None]
-        ts = ts.type(torch.float64)
+            noised_coords = noised_coords * mask.type(noised_coords.dtype)[..., None]
 
         # predict noisy input with transformer
-        feats, prediction = self.transformer(noised_coords,
-                                             ts,
-                                             context=seq,
-                                             mask=mask)
+        feats, prediction = self.denoise(noised_coords,
+                                         ts,
+                                         context=seq,
+                                         mask=mask)
 
         # loss between original noise and prediction
         loss = F.mse_loss(prediction[cmask], noise[cmask])
@@ -120,9 +175,12 @@ class EnDenoiser(pl.LightningModule):
     def score(self, x):
         # sample with diffusion
         coords, seqs, masks = self.prepare_inputs(x)
-        model = self.transformer
         timesteps = self.diffusion.timesteps
-        samples = self.diffusion.sample(model, coords, seqs, masks, timesteps)
+        # traced graphs ignore neighbor lists, see TracedTransformer
+        neighbor_lists = self.transformer.make_neighbor_list(per_layer=True) if not exists(self.traced) else None
+        samples = self.diffusion.sample(self.denoise, coords, seqs, masks, timesteps, neighbor_lists=neighbor_lists,
+                                        num_steps=self.sample_steps, spacing=self.sample_spacing, eta=self.sample_eta,
+                                        keep='last')
         last_sample = samples[-1]
         dna = None
         if self.context:
@@ -198,7 +256,19 @@ class EnDenoiser(pl.LightningModule):
         parser.add_argument('--dim', type=int, default=128)
         parser.add_argument('--dim_head', type=int, default=64)
         parser.add_argument('--depth', type=int, default=8)
+        parser.add_argument('--neighbors', type=int, default=0)
+        parser.add_argument('--neighbor_search', type=str, default='dense')
+        parser.add_argument('--neighbor_skin', type=float, default=None)
+        parser.add_argument('--attn_chunk_size', type=int, default=None)
+        parser.add_argument('--value_pos_rank', type=int, default=None)
+        parser.add_argument('--share_pos_bias', action=argparse.BooleanOptionalAction)
+        parser.add_argument('--activation_checkpoint', action=argparse.BooleanOptionalAction)
+        parser.add_argument('--checkpoint_memory_mb', type=float, default=None)
+        parser.add_argument('--precision_policy', type=str, default='fp32')
         parser.add_argument('--timesteps', type=int, default=250)
+        parser.add_argument('--sample_steps', type=int, default=None)
+        parser.add_argument('--sample_spacing', type=str, default='uniform')
+        parser.add_argument('--sample_eta', type=float, default=1.)
         parser.add_argument('--trim', type=int, default=None)
         parser.add_argument('--schedule', type=str, default='linear')
         parser.add_argument('--context', action=argparse.BooleanOptionalAction)
@@ -207,9 +207,17 @@ class PredefinedNoiseSchedule(nn.Module):
 
 
 class GammaNetwork(nn.Module):
-    """The gamma network models a monotonic increasing function. Construction as in the VDM paper."""
+    """
+    The gamma network models a monotonic increasing function. Construction as in the VDM paper.
+
+    Given timesteps, gamma is tabulated over the grid t = 0, 1/T, ..., 1 when the network is
+    evaluated in eval mode without gradients, e.g. for sampling. Like the predefined schedules,
+    t is then looked up on the grid. The table is rebuilt when the weights change. Without
+    gradients the endpoints gamma_tilde(0) and gamma_tilde(1) are cached the same way, with
+    gradients they are evaluated together with t in a single pass.
+    """
 
-    def __init__(self):
+    def __init__(self, timesteps=None):
         super().__init__()
 
         self.l1 = PositiveLinear(1, 1)
@@ -218,6 +226,12 @@ class GammaNetwork(nn.Module):
 
         self.gamma_0 = torch.nn.Parameter(torch.tensor([-5.]))
         self.gamma_1 = torch.nn.Parameter(torch.tensor([10.]))
+
+        self.timesteps = timesteps
+        self.table = None
+        self.table_version = None
+        self.ends = None
+        self.ends_version = None
         self.show_schedule()
 
     def show_schedule(self, num_steps=50):
@@ -226,16 +240,44 @@ class GammaNetwork(nn.Module):
         print('Gamma schedule:')
         print(gamma.detach().cpu().numpy().reshape(num_steps))
 
+    def train(self, mode=True):
+        # training updates the weights, the table is rebuilt on the next frozen call
+        self.table = None
+        self.ends = None
+        return super().train(mode)
+
+    def weights_version(self):
+        return tuple((p._version, p.data_ptr()) for p in self.parameters())
+
+    def tabulate(self):
+        version = self.weights_version()
+        if self.table is None or version != self.table_version:
+            grid = torch.arange(self.timesteps + 1, device=self.gamma_0.device, dtype=self.gamma_0.dtype) / self.timesteps
+            with torch.no_grad():
+                self.table = self.compute_gamma(grid.view(-1, 1)).view(-1)
+            self.table_version = version
+        return self.table
+
     def gamma_tilde(self, t):
         l1_t = self.l1(t)
         return l1_t + self.l3(torch.sigmoid(self.l2(l1_t)))
 
-    def forward(self, t):
-        zeros, ones = torch.zeros_like(t), torch.ones_like(t)
-        # Not super efficient.
-        gamma_tilde_0 = self.gamma_tilde(zeros)
-        gamma_tilde_1 = self.gamma_tilde(ones)
-        gamma_tilde_t = self.gamma_tilde(t)
+    def compute_gamma(self, t):
+        ends = torch.tensor([[0.], [1.]], device=t.device, dtype=t.dtype)
+
+        if torch.is_grad_enabled():
+            # gamma_tilde at 0, 1 and t in a single pass
+            gamma_tilde = self.gamma_tilde(torch.cat([ends, t.reshape(-1, 1)]))
+            gamma_tilde_ends, gamma_tilde_t = gamma_tilde[:2], gamma_tilde[2:].view(t.shape)
+        else:
+            # the endpoints only depend on the weights
+            version = self.weights_version()
+            if self.ends is None or version != self.ends_version or self.ends.dtype != t.dtype:
+                self.ends = self.gamma_tilde(ends)
+                self.ends_version = version
+            gamma_tilde_ends, gamma_tilde_t = self.ends, self.gamma_tilde(t)
+
+        gamma_tilde_0, gamma_tilde_1 = gamma_tilde_ends[0], gamma_tilde_ends[1]
 
         # Normalize to [0, 1]
         normalized_gamma = (gamma_tilde_t - gamma_tilde_0) / (
@@ -246,6 +288,14 @@ class GammaNetwork(nn.Module):
 
         return gamma
 
+    def forward(self, t):
+        if self.timesteps is None or self.training or torch.is_grad_enabled():
+            return self.compute_gamma(t)
+
+        table = self.tabulate()
+        t_int = torch.round(t * self.timesteps).long().clamp(0, self.timesteps).to(table.device)
+        return table[t_int]
+
 
 def cdf_standard_gaussian(x):
     return 0.5 * (1. + torch.erf(x / math.sqrt(2)))
@@ -261,7 +311,7 @@ class EnVariationalDiffusion(nn.Module):
             dynamics: EGNN_dynamics_QM9, in_node_nf: int, n_dims: int,
             timesteps: int = 1000, parametrization='eps', noise_schedule='learned',
             noise_precision=1e-4, loss_type='vlb', norm_values=(1., 1., 1.),
-            norm_biases=(None, 0., 0.), include_charges=False):
+            norm_biases=(None, 0., 0.), include_charges=False, sanity_checks='always', sanity_check_every=10):
         super().__init__()
 
         assert loss_type in {'vlb', 'l2'}
@@ -275,7 +325,7 @@ class EnVariationalDiffusion(nn.Module):
         assert parametrization == 'eps'
 
         if noise_schedule == 'learned':
-            self.gamma = GammaNetwork()
+            self.gamma = GammaNetwork(timesteps=timesteps)
         else:
             self.gamma = PredefinedNoiseSchedule(noise_schedule, timesteps=timesteps,
                                                  precision=noise_precision)
@@ -294,6 +344,10 @@ class EnVariationalDiffusion(nn.Module):
         self.norm_biases = norm_biases
         self.register_buffer('buffer', torch.zeros(1))
 
+        # checks on sampled states are counted on device and reported once per trajectory
+        self.sanity = diffusion_utils.SanityChecks(sanity_checks, every=sanity_check_every)
+        self.sanity_counters = {}
+
         if noise_schedule != 'learned':
             self.check_issues_norm_values()
 
@@ -317,6 +371,15 @@ class EnVariationalDiffusion(nn.Module):
 
         return net_out
 
+    def phi_doubled(self, z_a, z_b, t_a, t_b, node_mask, edge_mask, context):
+        """Evaluates phi on two batches sharing masks and context as one batch of twice the size."""
+        def double(tensor):
+            return None if tensor is None else torch.cat([tensor, tensor], dim=0)
+
+        net_out = self.phi(torch.cat([z_a, z_b], dim=0), torch.cat([t_a, t_b], dim=0),
+                           double(node_mask), double(edge_mask), double(context))
+        return net_out.chunk(2, dim=0)
+
     def inflate_batch_array(self, array, target):
         """
         Inflates the batch array (array) with only a single axis (i.e. shape = (batch_size,), or possibly more empty
@@ -608,8 +671,24 @@ class EnVariationalDiffusion(nn.Module):
 
         diffusion_utils.assert_mean_zero_with_mask(z_t[:, :, :self.n_dims], node_mask)
 
-        # Neural net prediction.
-        net_out = self.phi(z_t, t, node_mask, edge_mask, context)
+        if t0_always:
+            # Compute noise values for t = 0.
+            t_zeros = torch.zeros_like(s)
+            gamma_0 = self.inflate_batch_array(self.gamma(t_zeros), x)
+            alpha_0 = self.alpha(gamma_0, x)
+            sigma_0 = self.sigma(gamma_0, x)
+
+            # Sample z_0 given x, h for timestep t, from q(z_t | x, h)
+            eps_0 = self.sample_combined_position_feature_noise(
+                n_samples=x.size(0), n_nodes=x.size(1), node_mask=node_mask)
+            z_0 = alpha_0 * xh + sigma_0 * eps_0
+
+            # Neural net prediction for z_t and z_0 in a single pass over the doubled batch.
+            net_out, net_out_0 = self.phi_doubled(
+                z_t, z_0, t, t_zeros, node_mask, edge_mask, context)
+        else:
+            # Neural net prediction.
+            net_out = self.phi(z_t, t, node_mask, edge_mask, context)
 
         # Compute the error.
         error = self.compute_error(net_out, gamma_t, eps)
@@ -639,21 +718,8 @@ class EnVariationalDiffusion(nn.Module):
             num_terms = self.T  # Since t=0 is not included here.
             estimator_loss_terms = num_terms * loss_t
 
-            # Compute noise values for t = 0.
-            t_zeros = torch.zeros_like(s)
-            gamma_0 = self.inflate_batch_array(self.gamma(t_zeros), x)
-            alpha_0 = self.alpha(gamma_0, x)
-            sigma_0 = self.sigma(gamma_0, x)
-
-            # Sample z_0 given x, h for timestep t, from q(z_t | x, h)
-            eps_0 = self.sample_combined_position_feature_noise(
-                n_samples=x.size(0), n_nodes=x.size(1), node_mask=node_mask)
-            z_0 = alpha_0 * xh + sigma_0 * eps_0
-
-            net_out = self.phi(z_0, t_zeros, node_mask, edge_mask, context)
-
             loss_term_0 = -self.log_pxh_given_z0_without_constants(
-                x, h, z_0, gamma_0, eps_0, net_out, node_mask)
+                x, h, z_0, gamma_0, eps_0, net_out_0, node_mask)
 
             assert kl_prior.size() == estimator_loss_terms.size()
             assert kl_prior.size() == neg_log_constants.size()
@@ -714,8 +780,108 @@ class EnVariationalDiffusion(nn.Module):
 
         return neg_log_pxh
 
-    def sample_p_zs_given_zt(self, s, t, zt, node_mask, edge_mask, context, fix_noise=False):
-        """Samples from zs ~ p(zs | zt). Only used during sampling."""
+    def vlb_timesteps(self, num_timesteps=None):
+        """
+        Timesteps of the variational lower bound terms and their weights. By default all of 0, ..., T.
+        Given num_timesteps, t = 0 and one t drawn from each of num_timesteps equally sized strata of
+        1, ..., T, weighted by the size of its stratum.
+        """
+        if num_timesteps is None or num_timesteps >= self.T:
+            return torch.arange(0, self.T + 1), torch.ones(self.T + 1)
+
+        assert num_timesteps > 0, 'num_timesteps must be positive'
+        bounds = torch.from_numpy(np.linspace(1, self.T + 1, num_timesteps + 1).astype(np.int64))
+        low, high = bounds[:-1], bounds[1:]
+        t_int = low + (torch.rand(num_timesteps) * (high - low)).long()
+
+        t_int = torch.cat([torch.zeros(1, dtype=torch.long), t_int])
+        weights = torch.cat([torch.ones(1), (high - low).float()])
+        return t_int, weights
+
+    @torch.no_grad()
+    def compute_vlb(self, x, h, node_mask, edge_mask, context, num_timesteps=None, chunk_size=None, memory_mb=1024):
+        """
+        Computes the variational lower bound as the sum of its terms over all timesteps, or over a
+        stratified subset, instead of the single sample estimate of compute_loss. Timesteps are
+        batched through phi, chunk_size at a time, by default as many as fit in memory_mb.
+        Returns the loss and a dict with the per timestep loss curves.
+        """
+        bs, n_nodes, _ = x.size()
+        xh = torch.cat([x, h['categorical'], h['integer']], dim=2)
+
+        t_int, weights = self.vlb_timesteps(num_timesteps)
+        t_int, weights = t_int.to(x.device), weights.to(x)
+
+        if chunk_size is None:
+            sample_memory = self.dynamics.sample_memory(n_nodes, x.dtype)
+            chunk_size = max(1, int(memory_mb * 2 ** 20 // (bs * sample_memory)))
+
+        def repeat(tensor, k):
+            return None if tensor is None else tensor.repeat(k, *((1,) * (tensor.dim() - 1)))
+
+        loss_t = []
+        for chunk in t_int.split(chunk_size):
+            # timestep major batch, every timestep of the chunk sees the whole batch
+            k = chunk.size(0)
+            chunk_t_int = chunk.repeat_interleave(bs).view(k * bs, 1)
+            x_k, xh_k, node_mask_k = repeat(x, k), repeat(xh, k), repeat(node_mask, k)
+            h_k = {'categorical': repeat(h['categorical'], k), 'integer': repeat(h['integer'], k)}
+
+            s = (chunk_t_int - 1).to(x) / self.T
+            t = chunk_t_int.to(x) / self.T
+            gamma_s = self.inflate_batch_array(self.gamma(s), xh_k)
+            gamma_t = self.inflate_batch_array(self.gamma(t), xh_k)
+
+            # Sample zt ~ Normal(alpha_t x, sigma_t)
+            eps = self.sample_combined_position_feature_noise(
+                n_samples=k * bs, n_nodes=n_nodes, node_mask=node_mask_k)
+            z_t = self.alpha(gamma_t, xh_k) * xh_k + self.sigma(gamma_t, xh_k) * eps
+
+            net_out = self.phi(z_t, t, node_mask_k, repeat(edge_mask, k), repeat(context, k))
+
+            # Terms for t > 0, weighted with SNR: (SNR(s-t) - 1) for epsilon parametrization.
+            error = self.compute_error(net_out, gamma_t, eps)
+            SNR_weight = (self.SNR(gamma_s - gamma_t) - 1).squeeze(1).squeeze(1)
+            loss_t_larger_than_zero = 0.5 * SNR_weight * error
+
+            # Term for t = 0, where gamma_t is gamma_0.
+            loss_term_0 = -self.log_pxh_given_z0_without_constants(
+                x_k, h_k, z_t, gamma_t, eps, net_out, node_mask_k)
+
+            t_is_zero = chunk_t_int.squeeze(1) == 0
+            loss_t.append(torch.where(t_is_zero, loss_term_0, loss_t_larger_than_zero).view(k, bs))
+
+        loss_t = torch.cat(loss_t).transpose(0, 1)
+
+        kl_prior = self.kl_prior(xh, node_mask)
+        neg_log_constants = -self.log_constants_p_x_given_z0(x, node_mask)
+
+        loss = kl_prior + neg_log_constants + (loss_t * weights).sum(1)
+
+        return loss, {'t': t_int, 'weights': weights, 'loss_t': loss_t,
+                      'kl_prior': kl_prior, 'neg_log_constants': neg_log_constants}
+
+    def vlb(self, x, h, node_mask=None, edge_mask=None, context=None, **kwargs):
+        """
+        Computes the NLL as the full variational lower bound of compute_vlb, kwargs are passed on.
+        Returns the NLL and the per timestep loss curves.
+        """
+        x, h, delta_log_px = self.normalize(x, h, node_mask)
+
+        neg_log_pxh, curves = self.compute_vlb(x, h, node_mask, edge_mask, context, **kwargs)
+
+        # Correct for normalization on x.
+        assert neg_log_pxh.size() == delta_log_px.size()
+        neg_log_pxh = neg_log_pxh - delta_log_px
+
+        return neg_log_pxh, curves
+
+    def sample_p_zs_given_zt(self, s, t, zt, node_mask, edge_mask, context, fix_noise=False, eta=1.):
+        """
+        Samples from zs ~ p(zs | zt) for any s < t. Only used during sampling. eta = 1 is the
+        ancestral update, eta < 1 scales its noise down as in DDIM, eta = 0 is deterministic.
+        """
+        assert 0. <= eta <= 1., 'eta must lie in [0, 1]'
         gamma_s = self.gamma(s)
         gamma_t = self.gamma(t)
 
@@ -729,20 +895,27 @@ class EnVariationalDiffusion(nn.Module):
         eps_t = self.phi(zt, t, node_mask, edge_mask, context)
 
         # Compute mu for p(zs | zt).
-        diffusion_utils.assert_mean_zero_with_mask(zt[:, :, :self.n_dims], node_mask)
-        diffusion_utils.assert_mean_zero_with_mask(eps_t[:, :, :self.n_dims], node_mask)
-        mu = zt / alpha_t_given_s - (sigma2_t_given_s / alpha_t_given_s / sigma_t) * eps_t
-
-        # Compute sigma for p(zs | zt).
-        sigma = sigma_t_given_s * sigma_s / sigma_t
+        if self.sanity.step():
+            self.sanity.mean_zero_with_mask('zt', zt[:, :, :self.n_dims], node_mask)
+            self.sanity.mean_zero_with_mask('eps_t', eps_t[:, :, :self.n_dims], node_mask)
+        if eta == 1:
+            mu = zt / alpha_t_given_s - (sigma2_t_given_s / alpha_t_given_s / sigma_t) * eps_t
+
+            # Compute sigma for p(zs | zt).
+            sigma = sigma_t_given_s * sigma_s / sigma_t
+        else:
+            # DDIM update, the predicted noise keeps the variance the sampled noise does not cover
+            sigma = eta * sigma_t_given_s * sigma_s / sigma_t
+            x_pred = (zt - sigma_t * eps_t) / self.alpha(gamma_t, target_tensor=zt)
+            mu = self.alpha(gamma_s, target_tensor=zt) * x_pred + torch.sqrt(sigma_s ** 2 - sigma ** 2) * eps_t
 
         # Sample zs given the paramters derived from zt.
-        zs = self.sample_normal(mu, sigma, node_mask, fix_noise)
+        zs = mu if eta == 0 else self.sample_normal(mu, sigma, node_mask, fix_noise)
 
         # Project down to avoid numerical runaway of the center of gravity.
         zs = torch.cat(
             [diffusion_utils.remove_mean_with_mask(zs[:, :, :self.n_dims],
-                                                   node_mask),
+                                                   node_mask, check=False),
              zs[:, :, self.n_dims:]], dim=2
         )
         return zs
@@ -760,10 +933,36 @@ class EnVariationalDiffusion(nn.Module):
         z = torch.cat([z_x, z_h], dim=2)
         return z
 
+    def sampling_timesteps(self, num_steps=None, spacing='uniform'):
+        """
+        Decreasing timesteps from T to 0 visited by the sampler, num_steps transitions with the
+        spacing of diffusion_utils.spaced_timesteps, every step by default.
+        """
+        assert num_steps is None or num_steps >= 1, 'num_steps must be at least 1'
+        num_points = None if num_steps is None else num_steps + 1
+        return diffusion_utils.spaced_timesteps(self.T, num_points, spacing)
+
+    def start_sanity_checks(self):
+        self.sanity.reset()
+        self.dynamics.pop_nan_resets()
+
+    def report_sanity_checks(self, x, node_mask):
+        """Counts the checks on the final sample and reports the whole trajectory with a single sync."""
+        if self.sanity.policy != 'off':
+            self.sanity.mean_zero_with_mask('x', x, node_mask)
+
+        nan_resets = self.dynamics.pop_nan_resets()
+        if nan_resets is not None:
+            self.sanity.count('nan_resets', nan_resets)
+
+        self.sanity_counters = self.sanity.report()
+        return self.sanity_counters
+
     @torch.no_grad()
-    def sample(self, n_samples, n_nodes, node_mask, edge_mask, context, fix_noise=False):
+    def sample(self, n_samples, n_nodes, node_mask, edge_mask, context, fix_noise=False,
+               num_steps=None, spacing='uniform', eta=1.):
         """
-        Draw samples from the generative model.
+        Draw samples from the generative model, over the timesteps given by sampling_timesteps.
         """
         if fix_noise:
             # Noise is broadcasted over the batch axis, useful for visualizations.
@@ -771,21 +970,21 @@ class EnVariationalDiffusion(nn.Module):
         else:
             z = self.sample_combined_position_feature_noise(n_samples, n_nodes, node_mask)
 
-        diffusion_utils.assert_mean_zero_with_mask(z[:, :, :self.n_dims], node_mask)
+        self.start_sanity_checks()
 
-        # Iteratively sample p(z_s | z_t) for t = 1, ..., T, with s = t - 1.
-        for s in reversed(range(0, self.T)):
-            s_array = torch.full((n_samples, 1), fill_value=s)
-            t_array = s_array + 1
-            s_array = s_array / self.T
-            t_array = t_array / self.T
+        # Iteratively sample p(z_s | z_t) for consecutive sampling timesteps t > s.
+        steps = self.sampling_timesteps(num_steps, spacing)
+        for t, s in zip(steps[:-1], steps[1:]):
+            s_array = torch.full((n_samples, 1), fill_value=s) / self.T
+            t_array = torch.full((n_samples, 1), fill_value=t) / self.T
 
-            z = self.sample_p_zs_given_zt(s_array, t_array, z, node_mask, edge_mask, context, fix_noise=fix_noise)
+            z = self.sample_p_zs_given_zt(s_array, t_array, z, node_mask, edge_mask, context,
+                                          fix_noise=fix_noise, eta=eta)
 
         # Finally sample p(x, h | z_0).
         x, h = self.sample_p_xh_given_z0(z, node_mask, edge_mask, context, fix_noise=fix_noise)
 
-        diffusion_utils.assert_mean_zero_with_mask(x, node_mask)
+        self.report_sanity_checks(x, node_mask)
 
         max_cog = torch.sum(x, dim=1, keepdim=True).abs().max().item()
         if max_cog > 5e-2:
@@ -796,45 +995,70 @@ class EnVariationalDiffusion(nn.Module):
         return x, h
 
     @torch.no_grad()
-    def sample_chain(self, n_samples, n_nodes, node_mask, edge_mask, context, keep_frames=None):
+    def iter_chain(self, n_samples, n_nodes, node_mask, edge_mask, context, keep_frames=None,
+                   num_steps=None, spacing='uniform', eta=1.):
         """
-        Draw samples from the generative model, keep the intermediate states for visualization purposes.
+        Draw samples from the generative model, yielding (frame index, unnormalized frame) for
+        keep_frames intermediate states spread over the trajectory, from frame keep_frames - 1
+        down to frame 0, the resulting x and h. Only the kept states are unnormalized.
         """
         z = self.sample_combined_position_feature_noise(n_samples, n_nodes, node_mask)
 
-        diffusion_utils.assert_mean_zero_with_mask(z[:, :, :self.n_dims], node_mask)
+        self.start_sanity_checks()
+
+        steps = self.sampling_timesteps(num_steps, spacing)
+        num_transitions = len(steps) - 1
 
         if keep_frames is None:
-            keep_frames = self.T
+            keep_frames = num_transitions
         else:
-            assert keep_frames <= self.T
-        chain = torch.zeros((keep_frames,) + z.size())
+            assert keep_frames <= num_transitions
 
-        # Iteratively sample p(z_s | z_t) for t = 1, ..., T, with s = t - 1.
-        for s in reversed(range(0, self.T)):
-            s_array = torch.full((n_samples, 1), fill_value=s)
-            t_array = s_array + 1
-            s_array = s_array / self.T
-            t_array = t_array / self.T
+        # Iteratively sample p(z_s | z_t) for consecutive sampling timesteps t > s.
+        for i, (t, s) in enumerate(zip(steps[:-1], steps[1:])):
+            s_array = torch.full((n_samples, 1), fill_value=s) / self.T
+            t_array = torch.full((n_samples, 1), fill_value=t) / self.T
 
             z = self.sample_p_zs_given_zt(
-                s_array, t_array, z, node_mask, edge_mask, context)
+                s_array, t_array, z, node_mask, edge_mask, context, eta=eta)
 
-            diffusion_utils.assert_mean_zero_with_mask(z[:, :, :self.n_dims], node_mask)
-
-            # Write to chain tensor.
-            write_index = (s * keep_frames) // self.T
-            chain[write_index] = self.unnormalize_z(z, node_mask)
+            # Frames are spread over the transitions left, each keeps its last state.
+            write_index = ((num_transitions - 1 - i) * keep_frames) // num_transitions
+            next_index = ((num_transitions - 2 - i) * keep_frames) // num_transitions
+            if write_index != next_index and write_index != 0:
+                yield write_index, self.unnormalize_z(z, node_mask)
 
         # Finally sample p(x, h | z_0).
         x, h = self.sample_p_xh_given_z0(z, node_mask, edge_mask, context)
 
-        diffusion_utils.assert_mean_zero_with_mask(x[:, :, :self.n_dims], node_mask)
+        self.report_sanity_checks(x[:, :, :self.n_dims], node_mask)
 
-        xh = torch.cat([x, h['categorical'], h['integer']], dim=2)
-        chain[0] = xh  # Overwrite last frame with the resulting x and h.
+        # The last frame is the resulting x and h.
+        yield 0, torch.cat([x, h['categorical'], h['integer']], dim=2)
+
+    @torch.no_grad()
+    def sample_chain(self, n_samples, n_nodes, node_mask, edge_mask, context, keep_frames=None,
+                     num_steps=None, spacing='uniform', eta=1., callback=None):
+        """
+        Draw samples from the generative model, keep the intermediate states for visualization purposes.
+        With a callback, e.g. a FrameFileSink, every frame is passed to callback(index, frame) as soon
+        as it is sampled instead of being kept, and only the last frame is returned.
+        """
+        frames = self.iter_chain(n_samples, n_nodes, node_mask, edge_mask, context, keep_frames=keep_frames,
+                                 num_steps=num_steps, spacing=spacing, eta=eta)
+
+        if callback is not None:
+            for index, frame in frames:
+                callback(index, frame)
+            return frame
+
+        chain = None
+        for index, frame in frames:
+            if chain is None:
+                chain = torch.zeros((index + 1,) + frame.size())
+            chain[index] = frame
 
-        chain_flat = chain.view(n_samples * keep_frames, *z.size()[1:])
+        chain_flat = chain.view(-1, *frame.size()[1:])
 
         return chain_flat
 
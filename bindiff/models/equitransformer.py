@@ -1,6 +1,9 @@
+import hashlib
+from collections import OrderedDict
+
 import torch
 from torch import nn, einsum
-from torch.utils.checkpoint import checkpoint_sequential
+from torch.utils.checkpoint import checkpoint
 
 from einops import rearrange, repeat
 from models.modules import (
@@ -18,6 +21,7 @@ from models.helpers import (
     l2norm,
     batched_index_select
 )
+from models.neighbors import grid_knn, NeighborList, adjacency_degrees
 
 
 class FeedForward(nn.Module):
@@ -57,13 +61,20 @@ class EquivariantAttention(nn.Module):
         neighbors=0,
         only_sparse_neighbors=False,
         valid_neighbor_radius=float('inf'),
+        neighbor_search='dense',
+        neighbor_cell_size=None,
+        attn_chunk_size=None,
         init_eps=1e-3,
         rel_pos_emb=None,
         edge_mlp_mult=2,
         norm_rel_coors=True,
         norm_coors_scale_init=1.,
         use_cross_product=False,
+        cross_product_mode='exact',
+        cross_chunk_size=16,
         talking_heads=False,
+        value_pos_rank=None,
+        dynamic_pos_bias=None,
         scale=8,
         dropout=0.
     ):
@@ -84,6 +95,15 @@ class EquivariantAttention(nn.Module):
         self.only_sparse_neighbors = only_sparse_neighbors
         self.valid_neighbor_radius = valid_neighbor_radius
 
+        assert neighbor_search in {'dense', 'grid'}, 'neighbor_search must be either dense or grid'
+        self.neighbor_search = neighbor_search
+        self.neighbor_cell_size = neighbor_cell_size
+
+        assert cross_product_mode in {'exact', 'factorized'}, 'cross_product_mode must be either exact or factorized'
+        assert not (exists(attn_chunk_size) and talking_heads), 'chunked attention does not support talking heads'
+        assert not (exists(attn_chunk_size) and use_cross_product and cross_product_mode == 'exact'), 'chunked attention only supports factorized cross products'
+        self.attn_chunk_size = attn_chunk_size
+
         attn_inner_dim = heads * dim_head
         self.heads = heads
         self.to_qkv = nn.Linear(dim, attn_inner_dim * 3, bias=False)
@@ -121,6 +141,8 @@ class EquivariantAttention(nn.Module):
         )
 
         self.use_cross_product = use_cross_product
+        self.cross_product_mode = cross_product_mode
+        self.cross_chunk_size = cross_chunk_size
         if use_cross_product:
             self.cross_coors_mlp = nn.Sequential(
                 nn.Linear(heads, coors_hidden_dim, bias=False),
@@ -139,13 +161,15 @@ class EquivariantAttention(nn.Module):
 
         self.rel_pos_emb = rel_pos_emb
 
-        self.dynamic_pos_bias_mlp = DynamicPositionBias(
+        # a single module may be shared across layers, see EnTransformer(share_pos_bias=True)
+        self.dynamic_pos_bias_mlp = default(dynamic_pos_bias, DynamicPositionBias(
             dim=dim // 2,
             heads=heads,
             dim_head=dim_head,
             depth=3,
-            input_dim=(2 if rel_pos_emb else 1)
-        )
+            input_dim=(2 if rel_pos_emb else 1),
+            value_pos_rank=value_pos_rank
+        ))
 
         # dropouts
         self.node_dropout = nn.Dropout(dropout)
@@ -159,6 +183,16 @@ class EquivariantAttention(nn.Module):
         if type(module) in {nn.Linear}:
             nn.init.normal_(module.weight, std=self.init_eps)
 
+    @staticmethod
+    def order_neighbors(nbhd_values, nbhd_indices, pos_cache):
+        # a shared position bias is reused by value of the neighbor indices, which are sorted by
+        # index so that layers selecting the same neighbors also list them in the same order
+        if not exists(pos_cache):
+            return nbhd_values, nbhd_indices
+
+        nbhd_indices, order = nbhd_indices.sort(dim=-1)
+        return nbhd_values.gather(-1, order), nbhd_indices
+
     def forward(
         self,
         feats,
@@ -166,7 +200,9 @@ class EquivariantAttention(nn.Module):
         time_emb=None,
         edges=None,
         mask=None,
-        adj_mat=None
+        adj_mat=None,
+        pos_cache=None,
+        neighbor_list=None
     ):
         b, n, _ = coors.size()
         h = self.heads
@@ -180,40 +216,71 @@ class EquivariantAttention(nn.Module):
 
         assert not (only_sparse_neighbors and not exists(adj_mat)), 'adjacency matrix must be passed in if only_sparse_neighbors is turned on'
 
-        # calculate coords relative distances
-        rel_coors = rearrange(coors, 'b i d -> b i () d') - rearrange(coors, 'b j d -> b () j d')
-        rel_dist = rel_coors.norm(p=2, dim=-1)
+        # full attention can be computed in blocks of keys without the dense pairwise tensors,
+        # the position bias is then built per block and never shared through pos_cache
+        if exists(self.attn_chunk_size) and not exists(adj_mat) and not (0 < num_nn < n):
+            out, coors_out = self.forward_chunked(feats, coors, edges=edges, mask=mask)
+            return self.project_out(out, time_emb), coors_out
 
         # calculate neighborhood indices
         nbhd_indices = None
         nbhd_masks = None
-        nbhd_ranking = rel_dist.clone()
 
-        # apply adjacency matrix
-        if exists(adj_mat):
-            if len(adj_mat.shape) == 2:
-                adj_mat = repeat(adj_mat, 'i j -> b i j', b=b)
+        if (self.neighbor_search == 'grid' or exists(neighbor_list)) and not exists(adj_mat) and 0 < num_nn < n:
+            # find nearest neighbors with a cell list, only relative coordinates of the selected pairs are built
+            if exists(neighbor_list):
+                assert neighbor_list.k == num_nn, 'neighbor list must be built for the same number of neighbors'
+                nbhd_values, nbhd_indices = neighbor_list(coors, mask=mask)
+            else:
+                nbhd_values, nbhd_indices = grid_knn(
+                    coors,
+                    num_nn,
+                    mask=mask,
+                    radius=valid_neighbor_radius,
+                    cell_size=self.neighbor_cell_size
+                )
+
+            nbhd_values, nbhd_indices = self.order_neighbors(nbhd_values, nbhd_indices, pos_cache)
+            nbhd_masks = torch.isfinite(nbhd_values) & (nbhd_values <= valid_neighbor_radius)
+
+            rel_coors = rearrange(coors, 'b i d -> b i () d') - batched_index_select(coors, nbhd_indices, dim=1)
+            rel_dist = rel_coors.norm(p=2, dim=-1)
+        else:
+            # calculate coords relative distances
+            rel_coors = rearrange(coors, 'b i d -> b i () d') - rearrange(coors, 'b j d -> b () j d')
+            rel_dist = rel_coors.norm(p=2, dim=-1)
 
-            self_mask = torch.eye(n, device=device).bool()
-            self_mask = rearrange(self_mask, 'i j -> () i j')
-            adj_mat.masked_fill_(self_mask, False)
+            nbhd_ranking = rel_dist.clone()
 
-            max_adj_neighbors = adj_mat.long().sum(dim=-1).max().item() + 1
+            # apply adjacency matrix
+            if exists(adj_mat):
+                if len(adj_mat.shape) == 2:
+                    adj_mat = repeat(adj_mat, 'i j -> b i j', b=b)
 
-            num_nn = max_adj_neighbors if only_sparse_neighbors else (num_nn + max_adj_neighbors)
-            valid_neighbor_radius = 0 if only_sparse_neighbors else valid_neighbor_radius
+                self_mask = torch.eye(n, device=device).bool()
+                self_mask = rearrange(self_mask, 'i j -> () i j')
+                adj_mat.masked_fill_(self_mask, False)
 
-            nbhd_ranking = nbhd_ranking.masked_fill(self_mask, -1.)
-            nbhd_ranking = nbhd_ranking.masked_fill(adj_mat, 0.)
+                max_adj_neighbors = adj_mat.long().sum(dim=-1).max().item() + 1
 
-        if 0 < num_nn < n:
-            # make sure padding does not end up becoming neighbors
-            if exists(mask):
-                ranking_mask = mask[:, :, None] * mask[:, None, :]
-                nbhd_ranking = nbhd_ranking.masked_fill(~ranking_mask, 1e5)
+                num_nn = max_adj_neighbors if only_sparse_neighbors else (num_nn + max_adj_neighbors)
+                valid_neighbor_radius = 0 if only_sparse_neighbors else valid_neighbor_radius
+
+                nbhd_ranking = nbhd_ranking.masked_fill(self_mask, -1.)
+                nbhd_ranking = nbhd_ranking.masked_fill(adj_mat, 0.)
+
+            if 0 < num_nn < n:
+                # make sure padding does not end up becoming neighbors
+                if exists(mask):
+                    ranking_mask = mask[:, :, None] * mask[:, None, :]
+                    nbhd_ranking = nbhd_ranking.masked_fill(~ranking_mask, 1e5)
+
+                nbhd_values, nbhd_indices = nbhd_ranking.topk(num_nn, dim = -1, largest = False)
+                nbhd_values, nbhd_indices = self.order_neighbors(nbhd_values, nbhd_indices, pos_cache)
+                nbhd_masks = nbhd_values <= valid_neighbor_radius
 
-            nbhd_values, nbhd_indices = nbhd_ranking.topk(num_nn, dim = -1, largest = False)
-            nbhd_masks = nbhd_values <= valid_neighbor_radius
+                rel_dist = batched_index_select(rel_dist, nbhd_indices, dim=2)
+                rel_coors = batched_index_select(rel_coors, nbhd_indices, dim=2)
 
         # derive queries keys and values
         q, k, v = self.to_qkv(feats).chunk(3, dim=-1)
@@ -222,24 +289,23 @@ class EquivariantAttention(nn.Module):
         # calculate nearest neighbors
         i = j = n
 
+        # keys and values are shared by all queries in the dense case
         if exists(nbhd_indices):
             i, j = nbhd_indices.shape[-2:]
             nbhd_indices_with_heads = repeat(nbhd_indices, 'b n d -> b h n d', h=h)
             k = batched_index_select(k, nbhd_indices_with_heads, dim=2)
             v = batched_index_select(v, nbhd_indices_with_heads, dim=2)
-            rel_dist = batched_index_select(rel_dist, nbhd_indices, dim=2)
-            rel_coors = batched_index_select(rel_coors, nbhd_indices, dim=2)
+            kv_pattern = 'b h i j d'
         else:
-            k = repeat(k, 'b h j d -> b h n j d', n = n)
-            v = repeat(v, 'b h j d -> b h n j d', n = n)
+            kv_pattern = 'b h j d'
 
         # prepare mask
         if exists(mask):
             q_mask = rearrange(mask, 'b i -> b 1 i 1')
-            k_mask = repeat(mask, 'b j -> b i j', i = n)
-
             if exists(nbhd_indices):
-                k_mask = batched_index_select(k_mask, nbhd_indices, dim = 2)
+                k_mask = batched_index_select(mask, nbhd_indices, dim = 1)
+            else:
+                k_mask = repeat(mask, 'b j -> b i j', i = n)
 
             k_mask = rearrange(k_mask, 'b i j -> b 1 i j')
 
@@ -255,19 +321,22 @@ class EquivariantAttention(nn.Module):
         rel_dist = -100 * rel_dist
         rel_dist = rearrange(rel_dist, 'b i j -> b 1 i j 1')
 
+        # sequence offsets to neighbors are looked up in a table by the position bias network
+        seq_rel_pos = None
+
         if self.rel_pos_emb:
-            seq = torch.arange(n, device=device, dtype=q.dtype)
-            seq_target_pos = nbhd_indices if exists(nbhd_indices) else rearrange(seq, 'j -> 1 j')
-            seq_rel_dist = rearrange(seq, 'i -> i 1') - seq_target_pos
-            seq_rel_dist = repeat(seq_rel_dist, 'i j -> b 1 i j 1', b=b)
-            rel_dist = torch.cat((rel_dist, seq_rel_dist), dim=-1)
+            seq = torch.arange(n, device=device)
+            if exists(nbhd_indices):
+                seq_rel_pos = rearrange(seq, 'i -> () i ()') - nbhd_indices
+                seq_rel_pos = rearrange(seq_rel_pos, 'b i j -> b 1 i j')
+            else:
+                seq_rel_pos = rearrange(seq, 'i -> () () i ()') - rearrange(seq, 'j -> () () () j')
 
-        qk_pos, value_pos = self.dynamic_pos_bias_mlp(rel_dist)
+        qk_pos, value_emb = self.dynamic_pos_bias_mlp(rel_dist, offsets=seq_rel_pos, max_offset=n - 1, cache=pos_cache, key=nbhd_indices)
 
         # calculate inner product for queries and keys
-        qk = einsum('b h i d, b h i j d -> b h i j', q, k) * (self.scale if not exists(edges) else 1)
+        qk = einsum(f'b h i d, {kv_pattern} -> b h i j', q, k) * (self.scale if not exists(edges) else 1)
         qk = qk + qk_pos
-        v = v + value_pos
 
         # add edge information and pass through edges MLP if needed
         if exists(edges):
@@ -294,42 +363,33 @@ class EquivariantAttention(nn.Module):
         rel_coors_sign = self.coors_gate(coors_mlp_input)
         rel_coors_sign = rearrange(rel_coors_sign, 'b i j h -> b i j 1 h')
 
+        # cross product, the softmax over neighbor pairs of summed weights factorises into
+        # a product of one softmax over i and one over j
         if self.use_cross_product:
-            rel_coors_i = repeat(rel_coors, 'b n i c -> b n (i j) c', j=j)
-            rel_coors_j = repeat(rel_coors, 'b n j c -> b n (i j) c', i=j)
+            cross_weights = self.cross_coors_mlp(coors_mlp_input)
 
-            cross_coors = torch.cross(rel_coors_i, rel_coors_j, dim=-1)
+            cross_weights = rearrange(cross_weights, 'b i j (h n) -> b i j h n', n=2)
 
-            cross_coors = self.norm_rel_coors(cross_coors)
-            cross_coors = repeat(cross_coors, 'b i j c -> b i j c h', h=h)
+            if exists(mask):
+                cross_weights = cross_weights.masked_fill(~rearrange(coor_mask, 'b i j 1 -> b i j 1 1'), mask_value)
+
+            cross_attn_i, cross_attn_j = cross_weights.softmax(dim=-3).unbind(dim=-1)
+
+            if self.cross_product_mode == 'factorized':
+                cross_out = self.factorized_cross_product(rel_coors, cross_attn_i, cross_attn_j)
+            else:
+                cross_out = self.exact_cross_product(rel_coors, cross_attn_i, cross_attn_j)
 
         rel_coors = self.norm_rel_coors(rel_coors)
         rel_coors = repeat(rel_coors, 'b i j c -> b i j c h', h=h)
 
         rel_coors = rel_coors * rel_coors_sign
 
-        # cross product
-        if self.use_cross_product:
-            cross_weights = self.cross_coors_mlp(coors_mlp_input)
-
-            cross_weights = rearrange(cross_weights, 'b i j (h n) -> b i j h n', n=2)
-            cross_weights_i, cross_weights_j = cross_weights.unbind(dim=-1)
-
-            cross_weights = rearrange(cross_weights_i, 'b n i h -> b n i 1 h') + rearrange(cross_weights_j, 'b n j h -> b n 1 j h')
-
-            if exists(mask):
-                cross_mask = (coor_mask[:, :, :, None, :] & coor_mask[:, :, None, :, :])
-                cross_weights = cross_weights.masked_fill(~cross_mask, mask_value)
-
-            cross_weights = rearrange(cross_weights, 'b n i j h -> b n (i j) h')
-            cross_attn = cross_weights.softmax(dim=-2)
-
         # aggregate and combine heads for coordinate updates
 
         rel_out = einsum('b i j h, b i j c h -> b i c h', coor_attn, rel_coors)
 
         if self.use_cross_product:
-            cross_out = einsum('b i j h, b i j c h -> b i c h', cross_attn, cross_coors)
             rel_out = torch.cat((rel_out, cross_out), dim=-1)
 
         coors_out = einsum('b n c h, h -> b n c', rel_out, self.coors_combine)
@@ -348,10 +408,170 @@ class EquivariantAttention(nn.Module):
         if exists(self.talking_heads):
             attn = self.talking_heads(attn)
 
-        # weighted sum of values and combine heads
+        # weighted sum of values and position values
+
+        out = einsum(f'b h i j, {kv_pattern} -> b h i d', attn, v)
+        out = out + self.dynamic_pos_bias_mlp.value_bias(attn, value_emb)
 
-        out = einsum('b h i j, b h i j d -> b h i d', attn, v)
+        return self.project_out(out, time_emb), coors_out
 
+    def forward_chunked(self, feats, coors, edges=None, mask=None):
+        b, n, _ = coors.size()
+        h = self.heads
+        chunk_size = self.attn_chunk_size
+        device = coors.device
+
+        # derive queries keys and values, cosine sim attention
+        q, k, v = self.to_qkv(feats).chunk(3, dim=-1)
+        q, k, v = map(lambda t: rearrange(t, 'b n (h d) -> b h n d', h=h), (q, k, v))
+        q, k = map(l2norm, (q, k))
+
+        seq = torch.arange(n, device=device)
+
+        # running maxima, normalizers and weighted sums for the node and coordinate softmaxes
+        node_max = q.new_full((b, h, n), float('-inf'))
+        node_norm = q.new_zeros((b, h, n))
+        node_out = torch.zeros_like(q)
+
+        coor_max = coors.new_full((b, n, h), float('-inf'))
+        coor_norm = coors.new_zeros((b, n, h))
+        rel_out = coors.new_zeros((b, n, 3, h))
+
+        # and for the pair of softmaxes weighting neighbor vectors of the factorized cross product
+        cross_max = coors.new_full((b, n, h, 2), float('-inf'))
+        cross_norm = coors.new_zeros((b, n, h, 2))
+        cross_sum = coors.new_zeros((b, n, h, 2, 3))
+
+        for start in range(0, n, chunk_size):
+            end = min(start + chunk_size, n)
+
+            rel_coors = rearrange(coors, 'b i d -> b i () d') - rearrange(coors[:, start:end], 'b j d -> b () j d')
+            rel_dist = -100 * rel_coors.norm(p=2, dim=-1)
+            rel_dist = rearrange(rel_dist, 'b i j -> b 1 i j 1')
+
+            seq_rel_pos = None
+            if self.rel_pos_emb:
+                seq_rel_pos = rearrange(seq, 'i -> () () i ()') - rearrange(seq[start:end], 'j -> () () () j')
+
+            qk_pos, value_emb = self.dynamic_pos_bias_mlp(rel_dist, offsets=seq_rel_pos, max_offset=n - 1)
+
+            qk = einsum('b h i d, b h j d -> b h i j', q, k[:, :, start:end]) * (self.scale if not exists(edges) else 1)
+            qk = qk + qk_pos
+
+            if exists(edges):
+                qk = rearrange(qk, 'b h i j -> b i j h')
+                qk = torch.cat((qk, edges[:, :, start:end]), dim = -1)
+                qk = self.edge_mlp(qk)
+                qk = rearrange(qk, 'b i j h -> b h i j')
+
+            block_mask = None
+            if exists(mask):
+                block_mask = rearrange(mask, 'b i -> b 1 i 1') & rearrange(mask[:, start:end], 'b j -> b 1 1 j')
+
+            # coordinate updates, softmax over keys accumulated across blocks
+            coors_mlp_input = rearrange(qk, 'b h i j -> b i j h')
+            coor_weights = self.coors_mlp(coors_mlp_input)
+
+            if exists(block_mask):
+                coor_mask = repeat(block_mask, 'b 1 i j -> b i j 1')
+                coor_weights = coor_weights.masked_fill(~coor_mask, max_neg_value(coor_weights))
+
+            if self.use_cross_product:
+                cross_weights = self.cross_coors_mlp(coors_mlp_input)
+                cross_weights = rearrange(cross_weights, 'b i j (h n) -> b i j h n', n=2)
+
+                if exists(block_mask):
+                    cross_weights = cross_weights.masked_fill(~rearrange(coor_mask, 'b i j 1 -> b i j 1 1'), max_neg_value(cross_weights))
+
+                block_max = torch.maximum(cross_max, cross_weights.amax(dim=2))
+                rescale = torch.exp(cross_max - block_max)
+                cross_exp = torch.exp(cross_weights - rearrange(block_max, 'b i h n -> b i 1 h n'))
+                cross_norm = cross_norm * rescale + cross_exp.sum(dim=2)
+                cross_sum = cross_sum * rearrange(rescale, 'b i h n -> b i h n 1') + einsum('b i j h n, b i j c -> b i h n c', cross_exp, self.cross_inputs(rel_coors))
+                cross_max = block_max
+
+            rel_coors_sign = self.coors_gate(coors_mlp_input)
+            rel_coors = self.norm_rel_coors(rel_coors)
+            rel_coors = rearrange(rel_coors, 'b i j c -> b i j c 1') * rearrange(rel_coors_sign, 'b i j h -> b i j 1 h')
+
+            block_max = torch.maximum(coor_max, coor_weights.amax(dim=-2))
+            rescale = torch.exp(coor_max - block_max)
+            coor_exp = torch.exp(coor_weights - rearrange(block_max, 'b i h -> b i 1 h'))
+            coor_norm = coor_norm * rescale + coor_exp.sum(dim=-2)
+            coor_exp = self.coor_dropout(coor_exp)
+            rel_out = rel_out * rearrange(rescale, 'b i h -> b i 1 h') + einsum('b i j h, b i j c h -> b i c h', coor_exp, rel_coors)
+            coor_max = block_max
+
+            # node attention, softmax over keys accumulated across blocks
+            sim = qk
+            if exists(block_mask):
+                sim = sim.masked_fill(~block_mask, max_neg_value(sim))
+
+            block_max = torch.maximum(node_max, sim.amax(dim=-1))
+            rescale = torch.exp(node_max - block_max)
+            attn = torch.exp(sim - rearrange(block_max, 'b h i -> b h i 1'))
+            node_norm = node_norm * rescale + attn.sum(dim=-1)
+            attn = self.node_dropout(attn)
+
+            block_out = einsum('b h i j, b h j d -> b h i d', attn, v[:, :, start:end])
+            block_out = block_out + self.dynamic_pos_bias_mlp.value_bias(attn, value_emb)
+            node_out = node_out * rearrange(rescale, 'b h i -> b h i 1') + block_out
+            node_max = block_max
+
+        out = node_out / rearrange(node_norm, 'b h i -> b h i 1')
+        rel_out = rel_out / rearrange(coor_norm, 'b i h -> b i 1 h')
+
+        if self.use_cross_product:
+            cross_coors = cross_sum / rearrange(cross_norm, 'b i h n -> b i h n 1')
+            cross_out = self.cross_coors_out(*cross_coors.unbind(dim=-2))
+            rel_out = torch.cat((rel_out, cross_out), dim=-1)
+
+        coors_out = einsum('b n c h, h -> b n c', rel_out, self.coors_combine)
+        return out, coors_out
+
+    def exact_cross_product(self, rel_coors, cross_attn_i, cross_attn_j):
+        # sum of normed cross products over all neighbor pairs, built for a block of
+        # cross_chunk_size i neighbors at a time so that memory stays linear in the number of neighbors
+        j = rel_coors.shape[-2]
+        chunk_size = self.cross_chunk_size
+        rel_coors_j = rearrange(rel_coors, 'b n j c -> b n 1 j c')
+        cross_out = 0.
+
+        for start in range(0, j, chunk_size):
+            rel_coors_i = rearrange(rel_coors[:, :, start:(start + chunk_size)], 'b n i c -> b n i 1 c')
+            rel_coors_i, block_coors_j = torch.broadcast_tensors(rel_coors_i, rel_coors_j)
+
+            cross_coors = torch.cross(rel_coors_i, block_coors_j, dim=-1)
+            cross_coors = self.norm_rel_coors(cross_coors)
+
+            cross_coors = einsum('b n i j c, b n j h -> b n i c h', cross_coors, cross_attn_j)
+            cross_out = cross_out + einsum('b n i h, b n i c h -> b n c h', cross_attn_i[:, :, start:(start + chunk_size)], cross_coors)
+
+        return cross_out
+
+    def factorized_cross_product(self, rel_coors, cross_attn_i, cross_attn_j):
+        # weighted sums of neighbor vectors are crossed once per head, linear in the number of neighbors
+        rel_coors = self.cross_inputs(rel_coors)
+        coors_i = einsum('b n i h, b n i c -> b n h c', cross_attn_i, rel_coors)
+        coors_j = einsum('b n j h, b n j c -> b n h c', cross_attn_j, rel_coors)
+        return self.cross_coors_out(coors_i, coors_j)
+
+    def cross_inputs(self, rel_coors):
+        # with normed rel coors the neighbor vectors enter the factorized cross product as unit
+        # directions, the cross of their weighted sums is bilinear and is not normed again, as the
+        # sums are often nearly parallel and their cross product close to zero
+        if isinstance(self.norm_rel_coors, CoorsNorm):
+            return rel_coors / rel_coors.norm(dim=-1, keepdim=True).clamp(min=self.norm_rel_coors.eps)
+        return rel_coors
+
+    def cross_coors_out(self, coors_i, coors_j):
+        cross_coors = torch.cross(coors_i, coors_j, dim=-1)
+        if isinstance(self.norm_rel_coors, CoorsNorm):
+            cross_coors = cross_coors * self.norm_rel_coors.scale
+        return rearrange(cross_coors, 'b n h c -> b n c h')
+
+    def project_out(self, out, time_emb=None):
+        # combine heads
         out = rearrange(out, 'b h n d -> b n (h d)')
         out = self.to_out(out)
 
@@ -363,7 +583,7 @@ class EquivariantAttention(nn.Module):
             scale, shift = scale_shift
             out = out * (scale + 1) + shift
 
-        return out, coors_out
+        return out
 
 
 class Block(nn.Module):
@@ -372,9 +592,9 @@ class Block(nn.Module):
         self.attn = attn
         self.ff = ff
 
-    def forward(self, inp, time_emb=None, coor_changes=None):
+    def forward(self, inp, time_emb=None, coor_changes=None, pos_cache=None, neighbor_list=None):
         feats, coors, mask, edges, adj_mat = inp
-        feats, coors = self.attn(feats, coors, time_emb=time_emb, edges=edges, mask=mask, adj_mat=adj_mat)
+        feats, coors = self.attn(feats, coors, time_emb=time_emb, edges=edges, mask=mask, adj_mat=adj_mat, pos_cache=pos_cache, neighbor_list=neighbor_list)
 
         feats, coors = self.ff(feats, coors)
         return (feats, coors, mask, edges, adj_mat)
@@ -397,13 +617,23 @@ class EnTransformer(nn.Module):
         only_sparse_neighbors=False,
         num_adj_degrees=None,
         adj_dim=0,
+        adj_cache_size=16,
         valid_neighbor_radius=float('inf'),
+        neighbor_search='dense',
+        neighbor_cell_size=None,
+        neighbor_skin=None,
+        attn_chunk_size=None,
         init_eps=1e-3,
         norm_rel_coors=True,
         norm_coors_scale_init=1.,
         use_cross_product=False,
+        cross_product_mode='exact',
+        cross_chunk_size=16,
         talking_heads=False,
+        value_pos_rank=None,
+        share_pos_bias=False,
         checkpoint=False,
+        checkpoint_memory_mb=None,
         attn_dropout=0.,
         ff_dropout=0.
     ):
@@ -432,7 +662,42 @@ class EnTransformer(nn.Module):
         self.adj_emb = nn.Embedding(num_adj_degrees + 1, adj_dim) if exists(num_adj_degrees) and adj_dim > 0 else None
         adj_dim = adj_dim if exists(num_adj_degrees) else 0
 
-        self.checkpoint = checkpoint
+        # adjacency degrees of recently seen topologies, least recently used evicted first
+        self.adj_cache = OrderedDict()
+        self.adj_cache_size = adj_cache_size
+
+        # optionally share one position bias network across layers, its pair embedding is then computed once per forward
+        self.share_pos_bias = share_pos_bias
+        dynamic_pos_bias = DynamicPositionBias(
+            dim=dim // 2,
+            heads=heads,
+            dim_head=dim_head,
+            depth=3,
+            input_dim=(2 if rel_pos_emb else 1),
+            value_pos_rank=value_pos_rank
+        ) if share_pos_bias else None
+
+        # optionally build the neighbor list once per forward and only rebuild it when atoms moved more than half the skin
+        self.neighbors = neighbors
+        self.valid_neighbor_radius = valid_neighbor_radius
+        self.neighbor_cell_size = neighbor_cell_size
+        self.neighbor_skin = neighbor_skin
+        self.attn_chunk_size = attn_chunk_size
+
+        # checkpoint all blocks, or with a memory budget only as many blocks as needed to fit it
+        self.checkpoint = checkpoint or exists(checkpoint_memory_mb)
+        self.checkpoint_memory_mb = checkpoint_memory_mb
+
+        # number of pairwise (b x i x j) activations a block keeps for backward, used to estimate its memory
+        has_edges = (edge_dim + adj_dim) > 0
+        self.pair_channels = (
+            12 * heads +
+            2 * coors_hidden_dim +
+            9 * (dim // 2) +
+            4 +
+            (4 * (heads + edge_dim + adj_dim) if has_edges else 0)
+        )
+
         self.layers = nn.ModuleList([])
 
         for ind in range(depth):
@@ -447,12 +712,19 @@ class EnTransformer(nn.Module):
                     neighbors=neighbors,
                     only_sparse_neighbors=only_sparse_neighbors,
                     valid_neighbor_radius=valid_neighbor_radius,
+                    neighbor_search=neighbor_search,
+                    neighbor_cell_size=neighbor_cell_size,
+                    attn_chunk_size=attn_chunk_size,
                     init_eps=init_eps,
                     rel_pos_emb=rel_pos_emb,
                     norm_rel_coors=norm_rel_coors,
                     norm_coors_scale_init=norm_coors_scale_init,
                     use_cross_product=use_cross_product,
+                    cross_product_mode=cross_product_mode,
+                    cross_chunk_size=cross_chunk_size,
                     talking_heads=talking_heads,
+                    value_pos_rank=value_pos_rank,
+                    dynamic_pos_bias=dynamic_pos_bias,
                     dropout=attn_dropout
                 )),
                 Residual(FeedForward(
@@ -461,6 +733,63 @@ class EnTransformer(nn.Module):
                 ))
             ))
 
+    def block_memory(self, b, n, dtype=torch.float32):
+        # rough activation memory of one block in bytes, dominated by the pairwise tensors
+        j = self.neighbors if 0 < self.neighbors < n else n
+        element_size = torch.finfo(dtype).bits // 8
+        return b * n * j * self.pair_channels * element_size
+
+    def num_checkpointed_blocks(self, b, n, dtype=torch.float32):
+        depth = len(self.layers)
+
+        if not exists(self.checkpoint_memory_mb):
+            return depth
+
+        # checkpointed blocks only keep their inputs, so checkpoint just enough blocks for the rest to fit
+        block_memory = self.block_memory(b, n, dtype)
+        budget = self.checkpoint_memory_mb * 2 ** 20
+        num_kept = int(budget // block_memory) if block_memory > 0 else depth
+        return max(depth - num_kept, 0)
+
+    def get_adj_degrees(self, adj_mat):
+        # topologies repeat across training and sampling steps, so degrees are cached by a hash of the edges
+        edges = adj_mat.bool().nonzero()
+        sha = hashlib.sha1(edges.cpu().numpy().tobytes())
+        key = (tuple(adj_mat.shape), adj_mat.device, self.num_adj_degrees, sha.hexdigest())
+
+        if key in self.adj_cache:
+            self.adj_cache.move_to_end(key)
+            adj_indices = self.adj_cache[key]
+            return adj_indices.long(), adj_indices > 0
+
+        adj_indices, adj_mat = adjacency_degrees(adj_mat, self.num_adj_degrees)
+
+        self.adj_cache[key] = adj_indices.to(torch.uint8)
+        if len(self.adj_cache) > self.adj_cache_size:
+            self.adj_cache.popitem(last=False)
+
+        return adj_indices, adj_mat
+
+    def make_neighbor_list(self, skin=None, per_layer=False):
+        skin = default(skin, self.neighbor_skin)
+
+        if not exists(skin) or self.neighbors <= 0:
+            return None
+
+        def make():
+            return NeighborList(
+                self.neighbors,
+                skin=skin,
+                radius=self.valid_neighbor_radius,
+                cell_size=self.neighbor_cell_size
+            )
+
+        # coordinates of one layer change little between sampling steps, while they do change across layers
+        if per_layer:
+            return [make() for _ in self.layers]
+
+        return make()
+
     def forward(
         self,
         coors,
@@ -469,6 +798,7 @@ class EnTransformer(nn.Module):
         edges=None,
         mask=None,
         adj_mat=None,
+        neighbor_list=None,
         return_coor_changes=False,
         **kwargs
     ):
@@ -495,15 +825,7 @@ class EnTransformer(nn.Module):
             if len(adj_mat.shape) == 2:
                 adj_mat = repeat(adj_mat.clone(), 'i j -> b i j', b=b)
 
-            adj_indices = adj_mat.clone().long()
-
-            for ind in range(self.num_adj_degrees - 1):
-                degree = ind + 2
-
-                next_degree_adj_mat = (adj_mat.float() @ adj_mat.float()) > 0
-                next_degree_mask = (next_degree_adj_mat.float() - adj_mat.float()).bool()
-                adj_indices.masked_fill_(next_degree_mask, degree)
-                adj_mat = next_degree_adj_mat.clone()
+            adj_indices, adj_mat = self.get_adj_degrees(adj_mat)
 
             if exists(self.adj_emb):
                 adj_emb = self.adj_emb(adj_indices)
@@ -515,14 +837,51 @@ class EnTransformer(nn.Module):
         coor_changes = [coors]
         inp = (feats, coors, mask, edges, adj_mat)
 
-        # if in training mode and checkpointing is designated, use checkpointing across blocks to save memory
-        if self.training and self.checkpoint:
-            inp = checkpoint_sequential(self.layers, len(self.layers), inp)
-        else:
-            # iterate through blocks
-            for layer in self.layers:
-                inp = layer(inp, time_emb=t)
-                coor_changes.append(inp[1])  # append coordinates for visualization
+        # chunked full attention builds the position bias per key block, there is nothing to share
+        chunked = exists(self.attn_chunk_size) and not exists(adj_mat) and not (0 < self.neighbors < seqlen)
+        pos_cache = {} if self.share_pos_bias and not chunked else None
+
+        # neighbor lists passed in by the caller are reused across calls, e.g. sampling steps
+        if not exists(neighbor_list) and exists(self.neighbor_skin) and not exists(adj_mat):
+            neighbor_list = self.make_neighbor_list()
+
+        # either a single list shared by all layers, or one list per layer
+        neighbor_lists = neighbor_list if isinstance(neighbor_list, (list, tuple)) else [neighbor_list] * len(self.layers)
+        assert len(neighbor_lists) == len(self.layers), 'one neighbor list must be passed in per layer'
+
+        # if in training mode and checkpointing is designated, checkpoint the last blocks to save memory
+        num_checkpointed = 0
+        if self.training and self.checkpoint and torch.is_grad_enabled():
+            num_checkpointed = self.num_checkpointed_blocks(b, seqlen, coors.dtype)
+
+            # the first block fills the shared position bias cache, so it always runs normally
+            if self.share_pos_bias:
+                num_checkpointed = min(num_checkpointed, len(self.layers) - 1)
+
+        first_checkpointed = len(self.layers) - num_checkpointed
+
+        # iterate through blocks
+        for ind, (layer, layer_neighbor_list) in enumerate(zip(self.layers, neighbor_lists)):
+            if ind >= first_checkpointed:
+                # recomputation must see the same caches as the forward, so blocks get a copy. neighbor
+                # lists are exact, a rebuild or reuse during recomputation finds the same neighbors
+                block_pos_cache = dict(pos_cache) if exists(pos_cache) else None
+
+                def run_block(feats, coors, layer=layer, block_pos_cache=block_pos_cache, block_neighbor_list=layer_neighbor_list):
+                    block_cache = dict(block_pos_cache) if exists(block_pos_cache) else None
+                    feats, coors, *_ = layer((feats, coors, mask, edges, adj_mat), time_emb=t, pos_cache=block_cache, neighbor_list=block_neighbor_list)
+                    return feats, coors, block_cache
+
+                # the entry the block left in its copy is handed on to later blocks, as without checkpointing
+                feats, coors, block_cache = checkpoint(run_block, *inp[:2], use_reentrant=False)
+                if exists(pos_cache):
+                    pos_cache.update(block_cache)
+
+                inp = (feats, coors, mask, edges, adj_mat)
+            else:
+                inp = layer(inp, time_emb=t, pos_cache=pos_cache, neighbor_list=layer_neighbor_list)
+
+            coor_changes.append(inp[1])  # append coordinates for visualization
 
         # return
         feats, coors, *_ = inp
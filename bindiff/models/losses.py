@@ -11,7 +11,8 @@ def assert_correctly_masked(variable, node_mask):
 
 def compute_loss_and_nll(generative_model, nodes_dist, x, h, node_mask, edge_mask, context):
     bs, n_nodes, n_dims = x.size()
-    edge_mask = edge_mask.view(bs, n_nodes * n_nodes)
+    if edge_mask is not None:
+        edge_mask = edge_mask.view(bs, n_nodes * n_nodes)
     assert_correctly_masked(x, node_mask)
 
     # Here x is a position tensor, and h is a dictionary with keys
@@ -33,3 +34,25 @@ def compute_loss_and_nll(generative_model, nodes_dist, x, h, node_mask, edge_mas
     mean_abs_z = 0.
 
     return nll, reg_term, mean_abs_z
+
+
+def compute_vlb_and_nll(generative_model, nodes_dist, x, h, node_mask, edge_mask, context, **kwargs):
+    # NLL from the full variational lower bound, kwargs are passed on to the vlb
+    bs, n_nodes, n_dims = x.size()
+    if edge_mask is not None:
+        edge_mask = edge_mask.view(bs, n_nodes * n_nodes)
+    assert_correctly_masked(x, node_mask)
+
+    nll, curves = generative_model.vlb(x, h, node_mask, edge_mask, context, **kwargs)
+
+    N = node_mask.squeeze(2).sum(1).long()
+
+    log_pN = nodes_dist.log_prob(N)
+
+    assert nll.size() == log_pN.size()
+    nll = nll - log_pN
+
+    # Average over batch.
+    nll = nll.mean(0)
+
+    return nll, curves
@@ -1,8 +1,9 @@
 import math
 import torch
 import torch.nn.functional as F
-from torch import nn
+from torch import nn, einsum
 from einops import rearrange
+from models.helpers import exists
 
 
 class DynamicPositionBias(nn.Module):
@@ -14,7 +15,8 @@ class DynamicPositionBias(nn.Module):
         depth,
         dim_head,
         input_dim = 1,
-        norm = True
+        norm = True,
+        value_pos_rank = None
     ):
         super().__init__()
         assert depth >= 1, 'depth for dynamic position bias MLP must be greater or equal to 1'
@@ -35,18 +37,90 @@ class DynamicPositionBias(nn.Module):
 
         self.heads = heads
         self.qk_pos_head = nn.Linear(dim, heads)
-        self.value_pos_head = nn.Linear(dim, dim_head * heads)
 
-    def forward(self, pos):
-        for layer in self.mlp:
+        # value position bias is either projected straight from the pair embedding (compatible with
+        # existing checkpoints) or through a low rank bottleneck shared across heads
+        self.value_pos_rank = value_pos_rank
+
+        if exists(value_pos_rank):
+            self.value_pos_down = nn.Linear(dim, value_pos_rank, bias=False)
+            self.value_pos_head = nn.Linear(value_pos_rank, dim_head * heads)
+        else:
+            self.value_pos_head = nn.Linear(dim, dim_head * heads)
+
+        # first layer pre-activations for each sequence offset, reused while the weights are unchanged
+        self.offset_preactivation_cache = None
+
+    def offset_preactivations(self, max_offset, device):
+        """
+        Offset part of the first linear layer's pre-activations for every sequence offset in
+        [-max_offset, max_offset]. This is a first layer only cache: the distance channel enters
+        the mlp alongside the offset, so the deeper layers and the output heads still run per pair.
+        """
+        linear = self.mlp[0][0]
+        version = (linear.weight._version, linear.bias._version, linear.weight.data_ptr(), linear.weight.dtype, device)
+        cached = self.offset_preactivation_cache
+
+        if not torch.is_grad_enabled() and exists(cached) and cached['version'] == version and cached['max_offset'] >= max_offset:
+            return cached['table'], cached['max_offset']
+
+        offsets = torch.arange(-max_offset, max_offset + 1, device = device, dtype = linear.weight.dtype)
+        table = rearrange(offsets, 'o -> o 1') * linear.weight[:, 1] + linear.bias
+
+        if not torch.is_grad_enabled():
+            self.offset_preactivation_cache = dict(version = version, max_offset = max_offset, table = table)
+
+        return table, max_offset
+
+    @staticmethod
+    def same_key(cached, key):
+        # dense layers pass no key, sparse layers their neighbor indices, which are built anew
+        # by every layer and so compared by value
+        if cached is key:
+            return True
+        return torch.is_tensor(cached) and torch.is_tensor(key) and cached.shape == key.shape and torch.equal(cached, key)
+
+    def forward(self, pos, offsets = None, max_offset = None, cache = None, key = None):
+        if exists(cache) and 'value_emb' in cache and self.same_key(cache['key'], key):
+            return cache['qk_pos'], cache['value_emb']
+
+        layers = self.mlp
+
+        # with integer sequence offsets (b 1 i j) bounded by max_offset, the first layer combines the
+        # distance channel with a lookup of the offset pre-activations instead of running on concatenated inputs
+        if exists(offsets):
+            linear, *first_rest = self.mlp[0]
+            table, table_offset = self.offset_preactivations(max_offset, pos.device)
+            pos = pos * linear.weight[:, 0] + table[offsets + table_offset]
+
+            for layer in first_rest:
+                pos = layer(pos)
+
+            layers = self.mlp[1:]
+
+        for layer in layers:
             pos = layer(pos)
 
         qk_pos = self.qk_pos_head(pos)
-        value_pos = self.value_pos_head(pos)
-
         qk_pos = rearrange(qk_pos, 'b 1 i j h -> b h i j')
-        value_pos = rearrange(value_pos, 'b 1 i j (h d) -> b h i j d', h = self.heads)
-        return qk_pos, value_pos
+
+        value_emb = self.value_pos_down(pos) if exists(self.value_pos_rank) else pos
+        value_emb = rearrange(value_emb, 'b 1 i j e -> b i j e')
+
+        if exists(cache):
+            cache.update(key = key, qk_pos = qk_pos, value_emb = value_emb)
+
+        return qk_pos, value_emb
+
+    def value_bias(self, attn, value_emb):
+        # attention weights are contracted with the pair embedding before the per head projection,
+        # which never materializes position values of shape (b, h, i, j, d_head)
+        pooled = einsum('b h i j, b i j e -> b h i e', attn, value_emb)
+        weight = rearrange(self.value_pos_head.weight, '(h d) e -> h d e', h = self.heads)
+        out = einsum('b h i e, h d e -> b h i d', pooled, weight)
+
+        bias = rearrange(self.value_pos_head.bias, '(h d) -> h 1 d', h = self.heads)
+        return out + attn.sum(dim = -1, keepdim = True) * bias
 
 
 class SinusoidalPositionEmbeddings(nn.Module):
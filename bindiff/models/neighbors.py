@@ -0,0 +1,281 @@
+import itertools
+import torch
+from models.helpers import exists, default
+
+
+def _cell_offsets(strides, device):
+    offsets = itertools.product((-1, 0, 1), repeat=3)
+    offsets = torch.tensor(list(offsets), device=device)
+    return (offsets * strides).sum(dim=-1)
+
+
+def _dense_knn(coors, queries, k, mask):
+    # exact nearest neighbors for a subset of flattened (batch * n) query atoms
+    b, n, _ = coors.shape
+    batch = torch.div(queries, n, rounding_mode='floor')
+    query_coors = coors.reshape(b * n, 1, 3)[queries]
+    dist = (query_coors - coors[batch]).norm(p=2, dim=-1)
+    dist = dist.masked_fill(~mask[batch], float('inf'))
+    return dist.topk(k, dim=-1, largest=False)
+
+
+def _estimate_cell_size(coors, mask, k, num_samples=64):
+    # size cells from the k-th neighbor distance of a few atoms, so that
+    # most queries find their neighbors in their own or an adjacent cell
+    b, n, _ = coors.shape
+    valid = mask.flatten().nonzero().squeeze(-1)
+    # evenly strided rather than random samples, neighbor search must not consume the global rng
+    samples = valid[torch.linspace(0, valid.shape[0] - 1, min(num_samples, valid.shape[0]), device=coors.device).long()]
+    kth_values, _ = _dense_knn(coors, samples, min(k, n), mask)
+    kth_values = kth_values[:, -1]
+    kth_values = kth_values[torch.isfinite(kth_values)]
+
+    if kth_values.numel() == 0:
+        return 1.
+
+    return kth_values.quantile(0.9).clamp(min=1e-3).item()
+
+
+def grid_knn(coors, k, mask=None, radius=float('inf'), cell_size=None, chunk_size=1024):
+    """
+    Finds the k nearest neighbors of every atom with a cell list, never building the
+    dense n x n distance matrix. Atoms are hashed into cubic cells and each query only
+    looks at the 27 cells around it. Queries whose k-th candidate is further away than
+    one cell fall back to an exact search against their own structure.
+
+    Returns distances and indices of shape (b, n, k), sorted by distance. Slots that
+    could not be filled (fewer than k valid atoms) have infinite distance and point
+    to the query itself.
+    """
+    b, n, _ = coors.shape
+    device = coors.device
+    coors = coors.detach()
+    num_atoms = b * n
+
+    if not exists(mask):
+        mask = torch.ones((b, n), dtype=torch.bool, device=device)
+
+    if not exists(cell_size):
+        cell_size = _estimate_cell_size(coors, mask, k)
+    cell_size = min(cell_size, radius)
+
+    # integer cell coordinates, with a one cell margin so neighbor offsets stay positive
+    lo = coors.masked_fill(~mask[..., None], float('inf')).amin(dim=1, keepdim=True)
+    lo = lo.masked_fill(~torch.isfinite(lo), 0.)
+    cells = torch.div(coors - lo, cell_size, rounding_mode='floor').long() + 1
+    cells = cells.masked_fill(~mask[..., None], 0)
+    grid = cells.amax(dim=(0, 1)) + 2
+
+    # hash cells of all structures into a single key space, padding goes last
+    strides = torch.stack((grid[1] * grid[2], grid[2], torch.ones_like(grid[2])))
+    batch_offset = torch.arange(b, device=device)[:, None] * grid.prod()
+    keys = (cells * strides).sum(dim=-1) + batch_offset
+    pad_key = b * grid.prod()
+    keys = keys.masked_fill(~mask, pad_key).flatten()
+
+    sorted_keys, order = keys.sort()
+    cell_keys, cell_counts = torch.unique_consecutive(sorted_keys, return_counts=True)
+    cell_starts = cell_counts.cumsum(dim=0) - cell_counts
+    cell_counts = cell_counts.masked_fill(cell_keys == pad_key, 0)
+    max_occupancy = max(cell_counts.max().item(), 1)
+
+    # look up the 27 surrounding cells of every atom
+    nbhd_keys = keys[:, None] + _cell_offsets(strides, device)[None, :]
+    pos = torch.searchsorted(cell_keys, nbhd_keys).clamp(max=cell_keys.shape[0] - 1)
+    found = cell_keys[pos] == nbhd_keys
+    counts = cell_counts[pos] * found
+
+    slots = torch.arange(max_occupancy, device=device)
+    candidates = cell_starts[pos][..., None] + slots
+    valid = slots < counts[..., None]
+    candidates = order[candidates.clamp(max=num_atoms - 1)].reshape(num_atoms, -1)
+    valid = valid.reshape(num_atoms, -1)
+
+    flat_coors = coors.reshape(num_atoms, 3)
+    dist = (flat_coors[:, None, :] - flat_coors[candidates]).norm(p=2, dim=-1)
+    dist = dist.masked_fill(~valid, float('inf'))
+
+    if dist.shape[-1] < k:
+        pad = k - dist.shape[-1]
+        dist = torch.cat((dist, dist.new_full((num_atoms, pad), float('inf'))), dim=-1)
+        candidates = torch.cat((candidates, candidates.new_zeros((num_atoms, pad))), dim=-1)
+
+    nbhd_values, nbhd_pos = dist.topk(k, dim=-1, largest=False)
+    nbhd_indices = candidates.gather(-1, nbhd_pos)
+
+    # atoms within one cell size are always found, anything beyond may have been missed
+    if cell_size < radius:
+        uncertain = (nbhd_values[:, -1] > cell_size) & mask.flatten()
+        queries = uncertain.nonzero().squeeze(-1)
+
+        for chunk in queries.split(chunk_size):
+            exact_values, exact_indices = _dense_knn(coors, chunk, k, mask)
+            nbhd_values[chunk] = exact_values
+            nbhd_indices[chunk] = exact_indices + torch.div(chunk, n, rounding_mode='floor')[:, None] * n
+
+    # back to per structure indices, unfilled slots point to the query itself
+    self_indices = torch.arange(num_atoms, device=device)[:, None]
+    nbhd_indices = torch.where(torch.isfinite(nbhd_values), nbhd_indices, self_indices) % n
+
+    return nbhd_values.reshape(b, n, k), nbhd_indices.reshape(b, n, k)
+
+
+class NeighborList:
+    """
+    Verlet style neighbor list that can be reused while coordinates move only a little,
+    e.g. across the layers of one forward pass or across sampling steps.
+
+    On a build, the max_candidates nearest atoms are stored for every query, together
+    with a cutoff below which the candidate set is known to be complete. Candidates are
+    doubled until that cutoff lies at least one skin beyond the k-th neighbor. The k nearest
+    neighbors are then picked from the candidates at the current coordinates. This is
+    exact as long as no atom moved more than half the skin since the build and the k-th
+    neighbor of every query is still at least one skin inside its cutoff, otherwise the
+    list is rebuilt.
+
+    Every call appends 'build' or 'reuse' to events, num_builds and num_reuses count them.
+    """
+    def __init__(self, k, skin=1., max_candidates=None, radius=float('inf'), cell_size=None):
+        assert skin > 0, 'skin must be positive'
+        self.k = k
+        self.skin = skin
+        self.max_candidates = default(max_candidates, 2 * k)
+        assert self.max_candidates >= k, 'max_candidates must be at least k'
+        self.radius = radius
+        self.cell_size = cell_size
+        self.reset()
+
+    def reset(self):
+        self.reference = None
+        self.mask = None
+        self.candidates = None
+        self.cutoff = None
+        self.events = []
+        self.num_builds = 0
+        self.num_reuses = 0
+
+    def build(self, coors, mask):
+        n = coors.shape[1]
+        num_candidates = min(self.max_candidates, n)
+
+        while True:
+            values, candidates = grid_knn(coors, num_candidates, mask=mask, radius=self.radius, cell_size=self.cell_size)
+
+            # every atom within cutoff of the query at build time is a candidate
+            cutoff = values[..., min(self.k, num_candidates) - 1] + 2 * self.skin
+            if num_candidates == n:
+                break
+
+            cutoff = torch.minimum(cutoff, values[..., -1])
+
+            # grow the candidates until they reach at least one skin beyond the k-th neighbor
+            kth_values = values[..., min(self.k, num_candidates) - 1]
+            if ((kth_values + self.skin < cutoff) | ~mask).all():
+                break
+
+            num_candidates = min(num_candidates * 2, n)
+
+        self.reference = coors.detach().clone()
+        self.mask = mask.clone()
+        self.candidates = candidates.masked_fill(~torch.isfinite(values), -1)
+        self.cutoff = cutoff
+        self.num_builds += 1
+        self.events.append('build')
+
+    def needs_rebuild(self, coors, mask):
+        if not exists(self.reference) or self.reference.shape != coors.shape or not torch.equal(self.mask, mask):
+            return True
+
+        displacement = (coors.detach() - self.reference).norm(p=2, dim=-1).masked_fill(~mask, 0.)
+        return displacement.amax().item() > self.skin / 2
+
+    def query(self, coors, mask):
+        b, n, _ = coors.shape
+        k = min(self.k, self.candidates.shape[-1])
+        valid = self.candidates >= 0
+        candidates = self.candidates.clamp(min=0)
+
+        coors = coors.detach()
+        candidate_coors = coors.gather(1, candidates.reshape(b, -1, 1).expand(-1, -1, 3)).reshape(b, n, -1, 3)
+        dist = (coors[:, :, None, :] - candidate_coors).norm(p=2, dim=-1)
+        dist = dist.masked_fill(~valid, float('inf'))
+
+        values, pos = dist.topk(k, dim=-1, largest=False)
+        indices = candidates.gather(-1, pos)
+
+        # unfilled slots point to the query itself, same as grid_knn
+        self_indices = torch.arange(n, device=coors.device)[None, :, None]
+        indices = torch.where(torch.isfinite(values), indices, self_indices)
+        return values, indices
+
+    def __call__(self, coors, mask=None):
+        b, n, _ = coors.shape
+
+        if not exists(mask):
+            mask = torch.ones((b, n), dtype=torch.bool, device=coors.device)
+
+        if not self.needs_rebuild(coors, mask):
+            values, indices = self.query(coors, mask)
+
+            # atoms outside the candidates are at least cutoff - skin away by now
+            kth_values = values[..., -1].masked_fill(~mask, 0.)
+            if (kth_values <= self.cutoff - self.skin).all():
+                self.num_reuses += 1
+                self.events.append('reuse')
+                return values, indices
+
+        self.build(coors, mask)
+        return self.query(coors, mask)
+
+
+def adjacency_degrees(adj_mat, num_degrees):
+    """
+    Breadth first search over a (b, n, n) boolean adjacency matrix. Returns the degree of
+    every pair up to num_degrees, i.e. the length of the shortest path between them with
+    0 for pairs further apart (and for the diagonal unless given), together with the
+    boolean matrix of all pairs within num_degrees hops.
+
+    Each hop only expands the frontier of newly reached pairs along the edge list, which
+    costs O(frontier x degree) instead of a dense n^3 matrix product.
+    """
+    b, n, _ = adj_mat.shape
+    device = adj_mat.device
+    adj_mat = adj_mat.bool()
+    adj_indices = adj_mat.long()
+
+    # edge list sorted by source, nodes flattened over the batch
+    batch, rows, cols = adj_mat.nonzero(as_tuple=True)
+    src = batch * n + rows
+    dst = batch * n + cols
+    counts = torch.bincount(src, minlength=b * n)
+    starts = counts.cumsum(dim=0) - counts
+
+    # the query itself is never reached through a path
+    reached = adj_mat | torch.eye(n, dtype=torch.bool, device=device)
+    reached = reached.flatten()
+    flat_indices = adj_indices.view(-1)
+
+    pair_src, pair_dst = src[rows != cols], dst[rows != cols]
+
+    for degree in range(2, num_degrees + 1):
+        # follow every edge leaving the frontier
+        degrees = counts[pair_dst]
+        hop_src = pair_src.repeat_interleave(degrees)
+        hop_starts = starts[pair_dst].repeat_interleave(degrees)
+        hop_offsets = torch.arange(hop_src.shape[0], device=device) - (degrees.cumsum(dim=0) - degrees).repeat_interleave(degrees)
+        hop_dst = dst[hop_starts + hop_offsets]
+
+        # pairs reached for the first time form the next frontier
+        pairs = hop_src * n + hop_dst % n
+        pairs = pairs[~reached[pairs]].unique()
+
+        if pairs.numel() == 0:
+            break
+
+        reached[pairs] = True
+        flat_indices[pairs] = degree
+
+        pair_src = torch.div(pairs, n, rounding_mode='floor')
+        pair_dst = torch.div(pairs, n * n, rounding_mode='floor') * n + pairs % n
+
+    return adj_indices, adj_indices > 0
@@ -0,0 +1,132 @@
+import os
+import hashlib
+import torch
+import torch.nn.functional as F
+from torch import nn
+from models.helpers import exists
+
+
+class _TraceInputs(nn.Module):
+    # torch.jit.trace only takes positional tensors
+    def __init__(self, model, has_context):
+        super().__init__()
+        self.model = model
+        self.has_context = has_context
+
+    def forward(self, coors, timesteps, context, mask):
+        context = context if self.has_context else None
+        return self.model(coors, timesteps, context=context, mask=mask)
+
+
+class TracedTransformer:
+    """
+    Inference wrapper around an EnTransformer that runs TorchScript traces instead of the
+    eager module. Sequences are padded up to a multiple of bucket_size, so one trace serves
+    every length within a bucket. Traces are specialized on (batch, length bucket, neighbors,
+    dtype, context) and on the weights, and are saved to cache_dir so later runs load them
+    instead of tracing again.
+
+    Neighbors are found with dense search inside the traced graph, as the grid search and
+    neighbor lists depend on data dependent control flow. Calls with edges or adjacency
+    matrices fall back to the eager module.
+    """
+    def __init__(self, model, cache_dir=None, bucket_size=64):
+        self.model = model
+        self.cache_dir = cache_dir
+        self.bucket_size = bucket_size
+        self.traces = {}
+
+        self.weights_version = None
+        self.weights_fingerprint = None
+
+        if exists(cache_dir):
+            os.makedirs(cache_dir, exist_ok=True)
+
+    def fingerprint(self):
+        # hash the weights once, and again only when a parameter changed in place or was replaced
+        state = self.model.state_dict()
+        version = tuple((t._version, t.data_ptr()) for t in state.values())
+
+        if version != self.weights_version:
+            sha = hashlib.sha1()
+            for name, t in state.items():
+                sha.update(name.encode())
+                sha.update(t.detach().cpu().contiguous().view(-1).view(torch.uint8).numpy().tobytes())
+
+            self.weights_version = version
+            self.weights_fingerprint = sha.hexdigest()[:16]
+            self.traces.clear()
+
+        return self.weights_fingerprint
+
+    def trace(self, coors, timesteps, context, mask, has_context):
+        attns = [layer.attn.fn for layer in self.model.layers]
+        neighbor_search = [attn.neighbor_search for attn in attns]
+
+        for attn in attns:
+            attn.neighbor_search = 'dense'
+
+        try:
+            with torch.no_grad():
+                traced = torch.jit.trace(_TraceInputs(self.model, has_context), (coors, timesteps, context, mask), check_trace=False)
+        finally:
+            for attn, search in zip(attns, neighbor_search):
+                attn.neighbor_search = search
+
+        return traced
+
+    def get_trace(self, coors, timesteps, context, mask, has_context):
+        b, n, _ = coors.shape
+        dtype = str(coors.dtype).replace('torch.', '')
+
+        # traces recorded under autocast keep the casts, so they get their own key
+        if torch.is_autocast_enabled() or torch.is_autocast_cpu_enabled():
+            dtype = f'{dtype}-autocast'
+
+        key = (b, n, self.model.neighbors, dtype, has_context, self.fingerprint())
+
+        if key in self.traces:
+            return self.traces[key]
+
+        path = None
+        if exists(self.cache_dir):
+            filename = 'en_transformer_b{}_n{}_k{}_{}_ctx{:d}_{}.pt'.format(*key)
+            path = os.path.join(self.cache_dir, filename)
+
+        if exists(path) and os.path.exists(path):
+            traced = torch.jit.load(path, map_location=coors.device)
+        else:
+            traced = self.trace(coors, timesteps, context, mask, has_context)
+
+            if exists(path):
+                torch.jit.save(traced, path)
+
+        self.traces[key] = traced
+        return traced
+
+    def __call__(self, coors, timesteps, context=None, edges=None, mask=None, adj_mat=None, neighbor_list=None, **kwargs):
+        if self.model.training or exists(edges) or exists(adj_mat):
+            return self.model(coors, timesteps, context=context, edges=edges, mask=mask, adj_mat=adj_mat, neighbor_list=neighbor_list, **kwargs)
+
+        b, n, _ = coors.shape
+        device = coors.device
+
+        if not exists(mask):
+            mask = torch.ones((b, n), dtype=torch.bool, device=device)
+
+        has_context = exists(context)
+        if not has_context:
+            context = torch.zeros((b, n), dtype=torch.long, device=device)
+
+        # pad up to the length bucket, padding is masked out of attention
+        padded = -n % self.bucket_size
+        coors = F.pad(coors, (0, 0, 0, padded))
+        context = F.pad(context, (0, padded))
+        mask = F.pad(mask, (0, padded), value=False)
+
+        traced = self.get_trace(coors, timesteps, context, mask, has_context)
+
+        with torch.no_grad():
+            feats, coors = traced(coors, timesteps, context, mask)
+
+        return feats[:, :n], coors[:, :n]
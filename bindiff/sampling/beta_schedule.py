@@ -12,12 +12,12 @@ import torch.nn.functional as F
 SCHEDULES = Literal["linear", "cosine", "quadratic"]
 
 
-def cosine_beta_schedule(timesteps: int, s: float = 8e-3) -> torch.Tensor:
+def cosine_beta_schedule(timesteps: int, s: float = 8e-3, dtype: torch.dtype = torch.float32) -> torch.Tensor:
     """
     Cosine scheduling https://arxiv.org/pdf/2102.09672.pdf
     """
     steps = timesteps + 1
-    x = torch.linspace(0, timesteps, steps)
+    x = torch.linspace(0, timesteps, steps, dtype=dtype)
     alphas_cumprod = torch.cos(((x / timesteps) + s) / (1 + s) * torch.pi * 0.5) ** 2
     alphas_cumprod = alphas_cumprod / alphas_cumprod[0]
     betas = 1 - (alphas_cumprod[1:] / alphas_cumprod[:-1])
@@ -25,15 +25,15 @@ def cosine_beta_schedule(timesteps: int, s: float = 8e-3) -> torch.Tensor:
 
 
 def linear_beta_schedule(
-    timesteps: int, beta_start=1e-4, beta_end=0.02
+    timesteps: int, beta_start=1e-4, beta_end=0.02, dtype: torch.dtype = torch.float32
 ) -> torch.Tensor:
-    return torch.linspace(beta_start, beta_end, timesteps)
+    return torch.linspace(beta_start, beta_end, timesteps, dtype=dtype)
 
 
 def quadratic_beta_schedule(
-    timesteps: int, beta_start=1e-4, beta_end=0.02
+    timesteps: int, beta_start=1e-4, beta_end=0.02, dtype: torch.dtype = torch.float32
 ) -> torch.Tensor:
-    betas = torch.linspace(-6, 6, timesteps)
+    betas = torch.linspace(-6, 6, timesteps, dtype=dtype)
     return torch.sigmoid(betas) * (beta_end - beta_start) + beta_start
 
 
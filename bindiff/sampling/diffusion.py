@@ -1,10 +1,13 @@
+import numpy as np
 import torch
 import sampling.beta_schedule as beta_schedule
+from torch import nn
 from tqdm import tqdm
 from einops import repeat
+from sampling.diffusion_utils import spaced_timesteps
 
 
-class Diffusion:
+class Diffusion(nn.Module):
 
     def __init__(
         self,
@@ -13,21 +16,25 @@ class Diffusion:
         timesteps=100,
         schedule='linear'
     ):
+        super().__init__()
 
         self.timesteps = timesteps
 
+        # schedule constants are built and kept in float64 whatever precision the network runs in, see _apply
+        dtype = torch.float64
+
         # precompute all betas
         if schedule == 'linear':
-            self.betas = beta_schedule.linear_beta_schedule(
-                timesteps, beta_small, beta_large
+            betas = beta_schedule.linear_beta_schedule(
+                timesteps, beta_small, beta_large, dtype=dtype
             )
 
         elif schedule == 'cosine':
-            self.betas = beta_schedule.cosine_beta_schedule(timesteps)
+            betas = beta_schedule.cosine_beta_schedule(timesteps, dtype=dtype)
 
         elif schedule == 'quadratic':
-            self.betas = beta_schedule.quadratic_beta_schedule(
-                timesteps, beta_small, beta_large
+            betas = beta_schedule.quadratic_beta_schedule(
+                timesteps, beta_small, beta_large, dtype=dtype
             )
 
         else:
@@ -36,22 +43,72 @@ class Diffusion:
             raise AttributeError(err)
 
         # precompute all alphas
-        a, ac, sqac, sq1ac, pv, sra = beta_schedule.compute_alphas(self.betas)
-        self.alphas = a
-        self.alphas_cumprod = ac
-        self.sqrt_alphas_cumprod = sqac
-        self.sqrt_one_minus_alphas_cumprod = sq1ac
-        self.posterior_variance = pv
-        self.sqrt_recip_alphas = sra
+        a, ac, sqac, sq1ac, pv, sra = beta_schedule.compute_alphas(betas)
+
+        # schedules follow the module across devices, they are rebuilt rather than checkpointed
+        schedules = dict(
+            betas=betas,
+            alphas=a,
+            alphas_cumprod=ac,
+            sqrt_alphas_cumprod=sqac,
+            sqrt_one_minus_alphas_cumprod=sq1ac,
+            posterior_variance=pv,
+            sqrt_recip_alphas=sra
+        )
+        for name, schedule in schedules.items():
+            self.register_buffer(name, schedule, persistent=False)
+        self.schedule_names = tuple(schedules)
+
+    def _apply(self, fn, *args, **kwargs):
+        # casts such as .half() or .float() leave the float64 schedules alone, they only follow device moves
+        schedules = {name: self._buffers.pop(name) for name in self.schedule_names}
+        try:
+            super()._apply(fn, *args, **kwargs)
+        finally:
+            for name, schedule in schedules.items():
+                device = fn(schedule[:0]).device
+                self._buffers[name] = schedule.to(device)
+        return self
 
     @staticmethod
     def extract(a, t, x_shape):
+        # gathers on the device of the schedule, a no-op move when t already lives there
         t = t.type(torch.int64)
         batch_size = t.shape[0]
-        out = a.gather(-1, t.cpu())
+        out = a.gather(-1, t.to(a.device))
         out = out.reshape(batch_size, *((1,) * (len(x_shape) - 1)))
         return out.to(t.device)
 
+    def run_constants(self, steps, eta=1.):
+        """
+        Per step constants of a whole sampling run over the decreasing timesteps steps, gathered
+        once from the schedules. Returns one dict of scalar tensors per step.
+        """
+        assert 0. <= eta <= 1., 'eta must lie in [0, 1]'
+        t = torch.tensor(steps, device=self.betas.device)
+        prev = torch.tensor(steps[1:] + [-1], device=self.betas.device)
+
+        # ddim jumps to the next timestep of the run, or to the clean sample after the last one
+        alphas_cumprod_t = self.alphas_cumprod[t]
+        alphas_cumprod_prev = torch.where(
+            prev >= 0, self.alphas_cumprod[prev.clamp(min=0)], torch.ones_like(alphas_cumprod_t)
+        )
+        sigma = eta * torch.sqrt(
+            (1. - alphas_cumprod_prev) / (1. - alphas_cumprod_t) * (1. - alphas_cumprod_t / alphas_cumprod_prev)
+        )
+
+        table = dict(
+            betas=self.betas[t],
+            sqrt_one_minus_alphas_cumprod=self.sqrt_one_minus_alphas_cumprod[t],
+            sqrt_recip_alphas=self.sqrt_recip_alphas[t],
+            posterior_std=torch.sqrt(self.posterior_variance[t]),
+            alphas_cumprod=alphas_cumprod_t,
+            alphas_cumprod_prev=alphas_cumprod_prev,
+            sigma=sigma
+        )
+        # one element views keep the float64 type promotion of the schedules
+        return [{name: value[k:k + 1] for name, value in table.items()} for k in range(len(steps))]
+
     def q_sample(self, x_start, mask, t, noise=None):
         # generate random noise
         if noise is None:
@@ -82,22 +139,45 @@ class Diffusion:
 
         return noised_x, noise
 
-    @torch.no_grad()
-    def p_sample(self, model, coords, seqs, masks, t, t_index):
-        s = coords.shape
+    @staticmethod
+    def neighbor_counts(neighbor_lists):
+        # total reuses (hits) and rebuilds of the neighbor lists carried across timesteps
+        if neighbor_lists is None:
+            return 0, 0
 
-        # extract alhpas
-        betas_t = self.extract(self.betas, t, s)
-        sqrt_one_minus_alphas_cumprod_t = self.extract(
-            self.sqrt_one_minus_alphas_cumprod, t, s
-        )
-        sqrt_recip_alphas_t = self.extract(self.sqrt_recip_alphas, t, s)
+        if not isinstance(neighbor_lists, (list, tuple)):
+            neighbor_lists = [neighbor_lists]
 
+        hits = sum(nl.num_reuses for nl in neighbor_lists)
+        rebuilds = sum(nl.num_builds for nl in neighbor_lists)
+        return hits, rebuilds
+
+    def respace(self, num_steps=None, spacing='uniform'):
+        # decreasing subsequence of the trained timesteps, from timesteps - 1 down to 0
+        return spaced_timesteps(self.timesteps - 1, num_steps, spacing)
+
+    @staticmethod
+    def predict_noise(model, coords, seqs, masks, t, neighbor_lists=None):
         # inference from the model
-        _, prediction = model(coords, t, context=seqs, mask=masks)
+        if neighbor_lists is not None:
+            _, prediction = model(coords, t, context=seqs, mask=masks, neighbor_list=neighbor_lists)
+        else:
+            _, prediction = model(coords, t, context=seqs, mask=masks)
         # mask = repeat(masks, "b s -> b s c", c=3)
         mask = masks.unsqueeze(-1)
-        pred_noise = prediction * mask
+        return prediction * mask
+
+    @torch.no_grad()
+    def p_sample(self, model, coords, seqs, masks, t, t_index, neighbor_lists=None, constants=None):
+        # constants of the step, gathered here unless precomputed for the run by run_constants
+        if constants is None:
+            constants = self.run_constants([t_index])[0]
+
+        betas_t = constants['betas']
+        sqrt_one_minus_alphas_cumprod_t = constants['sqrt_one_minus_alphas_cumprod']
+        sqrt_recip_alphas_t = constants['sqrt_recip_alphas']
+
+        pred_noise = self.predict_noise(model, coords, seqs, masks, t, neighbor_lists=neighbor_lists)
 
         # calculate mean based on the model prediction
         model_mean = sqrt_recip_alphas_t * (
@@ -108,33 +188,112 @@ class Diffusion:
             return model_mean
 
         else:
-            posterior_variance_t = self.extract(self.posterior_variance, t, s)
             noise = torch.randn_like(coords)
-            return model_mean + torch.sqrt(posterior_variance_t) * noise
+            return model_mean + constants['posterior_std'] * noise
+
+    @torch.no_grad()
+    def ddim_sample(self, model, coords, seqs, masks, t, t_index, prev_index, eta=0., neighbor_lists=None, constants=None):
+        # jumps from t_index to prev_index < t_index, prev_index -1 is the clean sample
+        if constants is None:
+            steps = [t_index] if prev_index < 0 else [t_index, prev_index]
+            constants = self.run_constants(steps, eta)[0]
+
+        alphas_cumprod_t = constants['alphas_cumprod']
+        alphas_cumprod_prev = constants['alphas_cumprod_prev']
+        sigma = constants['sigma']
+
+        pred_noise = self.predict_noise(model, coords, seqs, masks, t, neighbor_lists=neighbor_lists)
+
+        # clean sample implied by the predicted noise
+        pred_start = (coords - torch.sqrt(1. - alphas_cumprod_t) * pred_noise) / torch.sqrt(alphas_cumprod_t)
+
+        # eta = 1 matches the ancestral posterior variance, eta = 0 is deterministic
+        direction = torch.sqrt(1. - alphas_cumprod_prev - sigma ** 2) * pred_noise
+        mean = torch.sqrt(alphas_cumprod_prev) * pred_start + direction
+
+        if eta == 0 or prev_index < 0:
+            return mean
+
+        noise = torch.randn_like(coords) * masks.unsqueeze(-1)
+        return mean + sigma * noise
+
+    @staticmethod
+    def kept_frames(keep, num_frames):
+        # frame 0 is the initial noise, frame j the state after j sampling steps
+        last = num_frames - 1
+        if keep == 'all':
+            return set(range(num_frames))
+        if keep == 'last':
+            return {last}
+        if isinstance(keep, int):
+            assert keep > 0, 'keep must keep every k-th frame for a positive k'
+            return set(range(0, num_frames, keep)) | {last}
+        if isinstance(keep, (list, tuple)):
+            assert all(-num_frames <= j <= last for j in keep), f'frames to keep must lie in [0, {last}]'
+            return {j % num_frames for j in keep}
+        raise ValueError(f"keep must be 'all', 'last', an int or a list of frames, received: {keep}")
 
     @torch.no_grad()
-    def sample(self, model, coords, seqs, masks, timesteps):
+    def sample(self, model, coords, seqs, masks, timesteps, neighbor_lists=None, num_steps=None, spacing='uniform', eta=1.,
+               keep='all', offload=None):
+        """
+        Samples from the reverse process and returns the frames picked by keep: 'all', 'last', every
+        k-th frame for an int k, or a list of frames, where frame 0 is the initial noise and frame j
+        the state after j steps. offload='cpu' moves kept frames off the device. A callable offload,
+        e.g. a FrameFileSink, is called with (frame index, state) instead and only the last frame is returned.
+        """
         b = coords.size(0)
         mask = masks.unsqueeze(-1)
 
+        # the full schedule runs the ancestral update, respaced schedules the ddim update
+        steps = self.respace(num_steps if num_steps is not None else timesteps, spacing)
+        ancestral = eta == 1 and steps == list(reversed(range(0, self.timesteps)))
+        run_constants = self.run_constants(steps, eta)
+
+        kept = self.kept_frames(keep, len(steps) + 1)
+        assert offload is None or offload == 'cpu' or callable(offload), "offload must be None, 'cpu' or a callable sink"
+        results = []
+
+        def retain(j, frame):
+            if j not in kept:
+                return
+            if callable(offload):
+                offload(j, frame)
+            else:
+                results.append(frame.cpu() if offload == 'cpu' else frame)
+
         # start with random gaussian noise
         res = torch.randn_like(coords)
-        results = [res]
+        retain(0, res)
 
         # iterate over timesteps with p_sample
         desc = 'sampling loop time step'
-        for i in tqdm(
-            reversed(range(0, timesteps)),
+        pbar = tqdm(
+            zip(steps, steps[1:] + [-1], run_constants),
             desc=desc,
-            total=timesteps
-        ):
-            # equal timestep to all samples in batch
-            ts = torch.full((b,), i).to(coords)  # all samples same t
+            total=len(steps)
+        )
+        for j, (i, prev, constants) in enumerate(pbar, start=1):
+            # equal timestep to all samples in batch, filled on the device
+            ts = torch.full((b,), i, dtype=coords.dtype, device=coords.device)  # all samples same t
             # override with context
             res = res * mask + coords * ~mask
             # forward diffusion
-            inference = self.p_sample(model, res, seqs, masks, ts, i)
-            results.append(inference)
+            if ancestral:
+                inference = self.p_sample(model, res, seqs, masks, ts, i, neighbor_lists=neighbor_lists, constants=constants)
+            else:
+                inference = self.ddim_sample(model, res, seqs, masks, ts, i, prev, eta=eta,
+                                             neighbor_lists=neighbor_lists, constants=constants)
+            retain(j, inference)
             res = inference
 
+            if neighbor_lists is not None:
+                hits, rebuilds = self.neighbor_counts(neighbor_lists)
+                pbar.set_postfix(nbhd_hits=hits, nbhd_rebuilds=rebuilds)
+
+        self.neighbor_hits, self.neighbor_rebuilds = self.neighbor_counts(neighbor_lists)
+
+        if callable(offload):
+            return [res]
+
         return results
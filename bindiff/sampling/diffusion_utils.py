@@ -1,3 +1,4 @@
+import warnings
 import torch
 import numpy as np
 
@@ -18,6 +19,40 @@ class EMA():
         return old * self.beta + (1 - self.beta) * new
 
 
+def spaced_timesteps(last, num_points=None, spacing='uniform'):
+    """Decreasing timesteps from last down to 0 visited by a sampler. spacing is 'uniform', 'quadratic'
+        (denser near 0) or an explicit list of timesteps, which must contain both 0 and last.
+        num_points timesteps are spread over [0, last], every timestep by default. Points that round to
+        the same timestep are merged with a warning, so fewer steps than asked for are run. A single point
+        is last alone, from which the sampler jumps straight to the clean sample.
+    """
+    if isinstance(spacing, (list, tuple)):
+        steps = [int(t) for t in spacing]
+        if not all(0 <= t <= last for t in steps):
+            raise ValueError(f'timesteps must lie in [0, {last}], received: {spacing}')
+        if 0 not in steps or last not in steps:
+            raise ValueError(f'explicit timesteps must contain both 0 and {last}, received: {spacing}')
+    elif spacing in ('uniform', 'quadratic'):
+        num_points = last + 1 if num_points is None else num_points
+        assert 1 <= num_points <= last + 1, f'number of timesteps must lie in [1, {last + 1}]'
+        if num_points == 1:
+            return [last]
+        if spacing == 'uniform':
+            grid = np.linspace(0, last, num_points)
+        else:
+            grid = np.linspace(0, np.sqrt(last), num_points) ** 2
+        steps = np.round(grid).astype(int).tolist()
+    else:
+        raise ValueError(f'spacing must be uniform, quadratic or a list of timesteps, received: {spacing}')
+
+    unique = sorted(set(steps), reverse=True)
+    if len(unique) < len(steps):
+        label = spacing if isinstance(spacing, str) else 'explicit'
+        warnings.warn(f'{len(steps) - len(unique)} of {len(steps)} timesteps with {label} spacing fall on the same '
+                      f'step and are merged, sampling visits {len(unique)} timesteps')
+    return unique
+
+
 def sum_except_batch(x):
     return x.reshape(x.size(0), -1).sum(dim=-1)
 
@@ -28,9 +63,11 @@ def remove_mean(x):
     return x
 
 
-def remove_mean_with_mask(x, node_mask):
-    masked_max_abs_value = (x * (1 - node_mask)).abs().sum().item()
-    assert masked_max_abs_value < 1e-5, f'Error {masked_max_abs_value} too high'
+def remove_mean_with_mask(x, node_mask, check=True):
+    # the check syncs with the host, callers that just masked x skip it
+    if check:
+        masked_max_abs_value = (x * (1 - node_mask)).abs().sum().item()
+        assert masked_max_abs_value < 1e-5, f'Error {masked_max_abs_value} too high'
     N = node_mask.sum(1, keepdims=True)
 
     mean = torch.sum(x, dim=1, keepdim=True) / N
@@ -38,6 +75,13 @@ def remove_mean_with_mask(x, node_mask):
     return x
 
 
+def remove_mean_packed(x, batch, num_graphs):
+    # x holds the real nodes of all graphs concatenated, batch is the graph of every node
+    counts = torch.bincount(batch, minlength=num_graphs).clamp(min=1)
+    mean = x.new_zeros((num_graphs, x.size(1))).index_add_(0, batch, x) / counts.unsqueeze(1).to(x)
+    return x - mean[batch]
+
+
 def assert_mean_zero(x):
     mean = torch.mean(x, dim=1, keepdim=True)
     assert mean.abs().max().item() < 1e-4
@@ -56,6 +100,53 @@ def assert_correctly_masked(variable, node_mask):
         'Variables not masked properly.'
 
 
+class SanityChecks():
+    """
+    Sanity checks for sampling trajectories. Violations are counted on device and only read
+    back by report, once per trajectory, instead of asserting with a host sync every step.
+    The policy is 'always', 'sampled' (every k-th step) or 'off'.
+    """
+    def __init__(self, policy='always', every=10):
+        assert policy in {'always', 'sampled', 'off'}, 'sanity checks must be always, sampled or off'
+        self.policy = policy
+        self.every = every
+        self.reset()
+
+    def reset(self):
+        self.steps = 0
+        self.counters = {}
+
+    def step(self):
+        # whether the checks run on this step
+        due = self.policy == 'always' or (self.policy == 'sampled' and self.steps % self.every == 0)
+        self.steps += 1
+        return due
+
+    def count(self, name, violations):
+        violations = violations.long().sum()
+        self.counters[name] = self.counters[name] + violations if name in self.counters else violations
+
+    def mean_zero_with_mask(self, name, x, node_mask, eps=1e-10):
+        masked_max_abs_value = (x * (1 - node_mask)).abs().max()
+        error = torch.sum(x, dim=1, keepdim=True).abs().max()
+        rel_error = error / (x.abs().max() + eps)
+        self.count(f'{name}_masking', masked_max_abs_value >= 1e-4)
+        self.count(f'{name}_mean', rel_error >= 1e-2)
+
+    def report(self):
+        # a single host sync for all counters
+        names = list(self.counters)
+        values = torch.stack([self.counters[name] for name in names]).tolist() if names else []
+        counters = dict(zip(names, values))
+
+        violations = {name: value for name, value in counters.items() if value > 0}
+        if violations:
+            print(f'Warning: sanity check violations {violations} over {self.steps} steps.')
+
+        self.reset()
+        return counters
+
+
 def center_gravity_zero_gaussian_log_likelihood(x):
     assert len(x.size()) == 3
     B, N, D = x.size()
@@ -112,7 +203,7 @@ def sample_center_gravity_zero_gaussian_with_mask(size, node_mask):
 
     # This projection only works because Gaussian is rotation invariant around
     # zero and samples are independent!
-    x_projected = remove_mean_with_mask(x_masked, node_mask)
+    x_projected = remove_mean_with_mask(x_masked, node_mask, check=False)
     return x_projected
 
 
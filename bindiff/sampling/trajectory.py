@@ -0,0 +1,30 @@
+import os
+import torch
+
+
+class FrameFileSink():
+    """
+    Writes sampled trajectory frames to a directory as they arrive, one file per frame, so
+    trajectories of many samples never have to be held in memory. Pass it as the callback of
+    EnVariationalDiffusion.sample_chain, or call it on the frames of iter_chain.
+    """
+    def __init__(self, directory, prefix='frame'):
+        self.directory = directory
+        self.prefix = prefix
+        self.indices = []
+        os.makedirs(directory, exist_ok=True)
+
+    def path(self, index):
+        return os.path.join(self.directory, f'{self.prefix}_{index:05d}.pt')
+
+    def __call__(self, index, frame):
+        torch.save(frame.detach().cpu(), self.path(index))
+        self.indices.append(index)
+
+    def load(self, index):
+        return torch.load(self.path(index))
+
+    def load_chain(self):
+        # frames stacked in index order, flattened as returned by sample_chain
+        frames = [self.load(index) for index in sorted(self.indices)]
+        return torch.stack(frames).view(-1, *frames[0].size()[1:])
@@ -114,11 +114,23 @@ def cli_main():
         beta_large=args.beta_large,
         lr=args.lr,
         depth=args.depth,
+        neighbors=args.neighbors,
+        neighbor_search=args.neighbor_search,
+        neighbor_skin=args.neighbor_skin,
+        attn_chunk_size=args.attn_chunk_size,
+        value_pos_rank=args.value_pos_rank,
+        share_pos_bias=args.share_pos_bias,
+        activation_checkpoint=args.activation_checkpoint,
+        checkpoint_memory_mb=args.checkpoint_memory_mb,
         schedule=args.schedule,
         timesteps=args.timesteps,
+        sample_steps=args.sample_steps,
+        sample_spacing=args.sample_spacing,
+        sample_eta=args.sample_eta,
         trim=args.trim,
         verbose=args.verbose,
         context=args.context,
+        precision_policy=args.precision_policy,
         ckpt_path=checkpoint_path
     )
 